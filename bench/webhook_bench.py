@@ -0,0 +1,101 @@
+"""
+Бенчмарк вебхука: обычный рантайм против FAST_RUNTIME=1 (uvloop + orjson).
+
+aiohttp-сервер бота (_build_http_app) поднимается в этом же процессе, клиент шлёт
+--total callback-апдейтов пачками по --concurrency. Апдейты только разбираются и кладутся
+в очередь (без хендлеров и Bot API), так что меряется сам приём: HTTP + JSON + Update.de_json.
+
+    python bench/webhook_bench.py               # оба профиля, по 2 прогона
+    python bench/webhook_bench.py --runs 5 --total 5000
+
+FAST_RUNTIME читается при импорте bot, поэтому каждый прогон — отдельный процесс.
+"""
+import argparse
+import asyncio
+import json
+import os
+import subprocess
+import sys
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+PAYLOAD = json.dumps({
+    "update_id": 1,
+    "callback_query": {
+        "id": "1",
+        "from": {"id": 5, "is_bot": False, "first_name": "x"},
+        "chat_instance": "c",
+        "data": "menu|week",
+        "message": {"message_id": 9, "date": 0, "chat": {"id": -100, "type": "supergroup"},
+                    "text": "Меню бота:" * 50},
+    },
+}).encode()
+
+
+class _FakeApp:
+    def __init__(self):
+        self.update_queue: asyncio.Queue = asyncio.Queue()
+        self.bot = None
+
+
+async def _run(total: int, concurrency: int) -> str:
+    import aiohttp
+    from aiohttp.test_utils import TestServer
+
+    import bot
+
+    app = _FakeApp()
+    srv = TestServer(bot._build_http_app(app))  # type: ignore[arg-type]
+    await srv.start_server()
+    url = str(srv.make_url(bot.WEBHOOK_PATH))
+    headers = {"X-Telegram-Bot-Api-Secret-Token": bot.WEBHOOK_SECRET, "Content-Type": "application/json"}
+    lat = []
+    async with aiohttp.ClientSession() as s:
+        async def one():
+            t = time.perf_counter()
+            async with s.post(url, data=PAYLOAD, headers=headers) as r:
+                await r.read()
+                assert r.status == 200, r.status
+            lat.append(time.perf_counter() - t)
+
+        t0 = time.perf_counter()
+        for _ in range(total // concurrency):
+            await asyncio.gather(*[one() for _ in range(concurrency)])
+        elapsed = time.perf_counter() - t0
+    await srv.close()
+    lat.sort()
+    return (f"FAST_RUNTIME={int(bot.FAST_RUNTIME)} uvloop={'on' if bot.FAST_RUNTIME and bot.uvloop else 'off'} "
+            f"orjson={'on' if bot._json_loads is not json.loads else 'off'}: "
+            f"{len(lat) / elapsed:.0f} req/s, p50 {lat[len(lat) // 2] * 1000:.1f} ms, "
+            f"p99 {lat[int(len(lat) * 0.99)] * 1000:.1f} ms")
+
+
+def _child(total: int, concurrency: int):
+    sys.path.insert(0, ROOT)
+    import bot
+
+    bot._install_fast_runtime()
+    print(asyncio.run(_run(total, concurrency)), flush=True)
+
+
+def main():
+    ap = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    ap.add_argument("--runs", type=int, default=2)
+    ap.add_argument("--total", type=int, default=2000)
+    ap.add_argument("--concurrency", type=int, default=50)
+    ap.add_argument("--child", action="store_true", help=argparse.SUPPRESS)
+    args = ap.parse_args()
+    if args.child:
+        _child(args.total, args.concurrency)
+        return
+    for _ in range(args.runs):
+        for fast in ("0", "1"):
+            env = dict(os.environ, FAST_RUNTIME=fast)
+            subprocess.run([sys.executable, os.path.abspath(__file__), "--child",
+                            "--total", str(args.total), "--concurrency", str(args.concurrency)],
+                           env=env, check=True)
+
+
+if __name__ == "__main__":
+    main()
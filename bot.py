@@ -1,13 +1,27 @@
 import os
+import sys
 import time
+import json
+import uuid
+import signal
+import hashlib
+import hmac
+import functools
+import contextvars
+import contextlib
+import sqlite3
 import asyncio
 import re
+import random
+import threading
 import calendar
+from collections import deque, OrderedDict
 from datetime import datetime, timedelta, timezone, date
-from typing import Dict, Tuple, List, Optional
+from typing import Any, Callable, Dict, Hashable, Iterator, Tuple, List, Optional
 
 import requests
 import aiohttp
+from aiohttp import web
 from telegram import (
     InlineKeyboardButton,
     InlineKeyboardMarkup,
@@ -16,16 +30,38 @@ from telegram import (
     ReplyKeyboardMarkup,
     BotCommand,
     Message,
+    InlineQueryResultArticle,
+    InputTextMessageContent,
+    InputMediaPhoto,
 )
 from telegram.ext import (
     Application,
+    BaseUpdateProcessor,
     CommandHandler,
     ContextTypes,
     MessageHandler,
     CallbackQueryHandler,
+    InlineQueryHandler,
     filters,
 )
-from telegram.error import Conflict, TimedOut, NetworkError, BadRequest
+from telegram.request import HTTPXRequest
+from telegram.error import Conflict, TimedOut, NetworkError, BadRequest, RetryAfter, Forbidden
+
+# Опциональный «быстрый» рантайм: uvloop + orjson (если установлены и FAST_RUNTIME=1)
+FAST_RUNTIME = os.getenv("FAST_RUNTIME", "0").strip().lower() in ("1", "true", "yes")
+try:
+    import orjson
+except ImportError:
+    orjson = None
+try:
+    import uvloop
+except ImportError:
+    uvloop = None
+
+if FAST_RUNTIME and orjson is not None:
+    _json_loads = orjson.loads
+else:
+    _json_loads = json.loads
 
 BOT_NAME = "dektrian_online_bot"
 
@@ -54,6 +90,23 @@ PORT = int(os.getenv("PORT", os.getenv("RENDER_PORT", "8080")))
 WEBHOOK_SECRET = os.getenv("WEBHOOK_SECRET", "dektrian-secret")
 WEBHOOK_PATH = os.getenv("WEBHOOK_PATH", f"/telegram/{BOT_NAME}")
 
+# === Режим работы: webhook (нужен PUBLIC_URL) или polling (локально, за NAT, нагрузочные тесты) ===
+BOT_MODE = (os.getenv("BOT_MODE") or ("webhook" if PUBLIC_URL else "polling")).strip().lower()
+POLL_TIMEOUT_SECONDS = int(os.getenv("POLL_TIMEOUT_SECONDS", "50"))
+POLL_BATCH_LIMIT = 100                  # максимум getUpdates
+POLL_REPORT_EVERY_SECONDS = 60
+POLL_MAX_INFLIGHT = int(os.getenv("POLL_MAX_INFLIGHT", "1000"))  # сколько апдейтов в работе, прежде чем притормозить getUpdates
+
+# === Рестарты без потерь ===
+SHUTDOWN_DRAIN_SECONDS = float(os.getenv("SHUTDOWN_DRAIN_SECONDS", "20"))  # Render даёт ~30 с после SIGTERM
+WEBHOOK_MAX_CONNECTIONS = int(os.getenv("WEBHOOK_MAX_CONNECTIONS", "40"))  # параллельность доставки бэклога
+
+# === Параллельная обработка апдейтов ===
+# Сколько апдейтов обрабатывается одновременно (1 = строго последовательно)
+MAX_CONCURRENT_UPDATES = max(1, int(os.getenv("MAX_CONCURRENT_UPDATES", "16")))
+# Лимит, который OrderedUpdateProcessor передаёт базовому классу (свой семафор — после блокировок по ключу)
+_UNBOUNDED_CONCURRENT_UPDATES = 1 << 20
+
 # >>> Dektrian chat config >>>
 # Публичные теги (строки) для целевых чатов
 STREAM_GROUP_TAG = "@dektrian_tv"        # стримерская группа — все функции
@@ -108,24 +161,235 @@ KB_LABEL_LOWER = KB_LABEL.lower()
 # TTL меню (сек)
 MENU_TTL_SECONDS = 15 * 60
 
+# Очередь удаления сообщений: период сброса (сек) и размер пачки deleteMessages (лимит API — 100)
+DELETE_FLUSH_INTERVAL_SECONDS = float(os.getenv("DELETE_FLUSH_INTERVAL_SECONDS", "1.5"))
+DELETE_BATCH_MAX = 100
+DELETE_MAX_ATTEMPTS = 3                 # временный сбой (сеть/лимиты) — столько попыток на сообщение
+
+# Ретраи и circuit breaker для внешних сервисов (Telegram/Google/Twitch/YouTube)
+RETRY_ATTEMPTS = int(os.getenv("RETRY_ATTEMPTS", "3"))
+RETRY_BASE_DELAY_SECONDS = 0.5
+RETRY_MAX_DELAY_SECONDS = 30.0          # дольше ждать не будем — сразу ошибка
+HTTP_TIMEOUT_SECONDS = 10
+BREAKER_FAILURE_THRESHOLD = 5           # подряд неудач до «размыкания»
+BREAKER_RESET_SECONDS = 60              # сколько секунд сервис считается «лежащим»
+
+# Локальное состояние бота в SQLite: outbox, закрепы, offset/журнал polling, TTL меню (переживает рестарт).
+# OUTBOX_PATH — прежнее имя переменной, поддерживается для совместимости
+STATE_DB_PATH = os.getenv("STATE_DB_PATH") or os.getenv("OUTBOX_PATH") or "bot_state.sqlite3"
+
+# Outbox: локальная очередь исходящих рассылок
+OUTBOX_WORKERS = max(1, int(os.getenv("OUTBOX_WORKERS", "4")))
+OUTBOX_MAX_ATTEMPTS = 8
+OUTBOX_WAIT_SECONDS = 120               # сколько рассылка ждёт доставки, прежде чем вернуть управление
+OUTBOX_KEEP_DONE_DAYS = 7
+
+# Сколько секунд считать список задач Google Tasks свежим (листание месяца без перезапроса)
+TASKS_CACHE_TTL_SECONDS = int(os.getenv("TASKS_CACHE_TTL_SECONDS", "120"))
+
+# Инлайн-режим (@dektrian_online_bot today/week/дата): кэш ответа на стороне Telegram (сек)
+INLINE_CACHE_SECONDS = int(os.getenv("INLINE_CACHE_SECONDS", "300"))
+# На сколько дней вперёд предрассчитывать ответы по датам
+INLINE_INDEX_DAYS = 31
+
+# Фиды /schedule.ics и /schedule.json: длительность события без явного конца (мин) и max-age для клиентов
+FEED_EVENT_DURATION_MIN = 120
+FEED_MAX_AGE_SECONDS = 300
+
+# Трассировка апдейтов и профилировщик (/admin/*; без ADMIN_TOKEN эндпоинты выключены)
+ADMIN_TOKEN = os.getenv("ADMIN_TOKEN", "").strip()
+TRACE_RECENT_MAX = 500                  # сколько последних апдейтов держим для выборки «самых медленных»
+TRACE_SLOWEST_SHOW = 20
+PROFILE_MAX_SECONDS = 60
+PROFILE_INTERVAL_SECONDS = 0.005
+
+# Антиспам: token bucket на пользователя и на чат (burst — запас, per_sec — пополнение)
+RATE_USER_BURST = float(os.getenv("RATE_USER_BURST", "5"))
+RATE_USER_PER_SEC = float(os.getenv("RATE_USER_PER_SEC", "0.5"))
+RATE_CHAT_BURST = float(os.getenv("RATE_CHAT_BURST", "20"))
+RATE_CHAT_PER_SEC = float(os.getenv("RATE_CHAT_PER_SEC", "2"))
+
+# Закреплённое расписание на неделю в SCHEDULE_REMINDER_CHAT_IDS
+PINNED_SCHEDULE_ENABLED = os.getenv("PINNED_SCHEDULE", "1").strip() not in ("0", "false", "no")
+PINNED_SYNC_SECONDS = 600               # как часто сверяться с Google Tasks
+
+# Реестр чатов: как часто перечитывать get_chat/права бота (мин)
+CHAT_REGISTRY_REFRESH_MIN = int(os.getenv("CHAT_REGISTRY_REFRESH_MIN", "360"))
+
+# Интервал логирования размеров in-memory структур (мин)
+MEMORY_REPORT_EVERY_MIN = int(os.getenv("MEMORY_REPORT_EVERY_MIN", "60"))
+
+# ========= Ограниченные структуры (LRU/TTL) =========
+class _BoundedEntry:
+    __slots__ = ("value", "expires_at")
+
+    def __init__(self, value: Any, expires_at: float):
+        self.value = value
+        self.expires_at = expires_at
+
+class BoundedMap:
+    """
+    Словарь с ограничением размера (вытеснение least-recently-used) и необязательным TTL.
+    С TTL порядок — порядок записи (чтение не двигает ключ), поэтому истёкшие всегда в голове
+    и purge_expired не сканирует всю карту; вытеснение по размеру тогда снимает самые старые записи.
+    on_evict(key, value) вызывается при вытеснении по размеру или по TTL (не при pop/clear).
+    """
+    __slots__ = ("name", "max_size", "ttl", "on_evict", "_data", "evictions", "expirations")
+
+    def __init__(self, name: str, max_size: int, ttl: Optional[float] = None,
+                 on_evict: Optional[Callable[[Any, Any], None]] = None):
+        self.name = name
+        self.max_size = max_size
+        self.ttl = ttl
+        self.on_evict = on_evict
+        self._data: "OrderedDict[Hashable, _BoundedEntry]" = OrderedDict()
+        self.evictions = 0
+        self.expirations = 0
+        _bounded_maps.append(self)
+
+    def _expired(self, e: _BoundedEntry, now: float) -> bool:
+        return bool(e.expires_at) and e.expires_at <= now
+
+    def _drop(self, key: Hashable, e: _BoundedEntry):
+        self._data.pop(key, None)
+        if self.on_evict:
+            try:
+                self.on_evict(key, e.value)
+            except Exception as ex:
+                print(f"[MEM] {self.name} on_evict error: {ex}")
+
+    def purge_expired(self):
+        if not self.ttl:
+            return
+        now = time.monotonic()
+        # с TTL get() не двигает ключи: порядок = порядок записи = порядок истечения
+        while self._data:
+            key, e = next(iter(self._data.items()))
+            if not self._expired(e, now):
+                break
+            self.expirations += 1
+            self._drop(key, e)
+
+    def __setitem__(self, key: Hashable, value: Any):
+        expires_at = time.monotonic() + self.ttl if self.ttl else 0.0
+        self._data[key] = _BoundedEntry(value, expires_at)
+        self._data.move_to_end(key)
+        self.purge_expired()
+        while len(self._data) > self.max_size:
+            old_key, old = next(iter(self._data.items()))
+            self.evictions += 1
+            self._drop(old_key, old)
+
+    def get(self, key: Hashable, default: Any = None) -> Any:
+        e = self._data.get(key)
+        if e is None:
+            return default
+        if self._expired(e, time.monotonic()):
+            self.expirations += 1
+            self._drop(key, e)
+            return default
+        if not self.ttl:
+            self._data.move_to_end(key)
+        return e.value
+
+    def __getitem__(self, key: Hashable) -> Any:
+        sentinel = object()
+        v = self.get(key, sentinel)
+        if v is sentinel:
+            raise KeyError(key)
+        return v
+
+    def __contains__(self, key: Hashable) -> bool:
+        e = self._data.get(key)
+        return e is not None and not self._expired(e, time.monotonic())
+
+    def pop(self, key: Hashable, default: Any = None) -> Any:
+        e = self._data.pop(key, None)
+        return default if e is None else e.value
+
+    def items(self) -> List[Tuple[Hashable, Any]]:
+        now = time.monotonic()
+        return [(k, e.value) for k, e in self._data.items() if not self._expired(e, now)]
+
+    def __iter__(self) -> Iterator[Hashable]:
+        return iter([k for k, _ in self.items()])
+
+    def __len__(self) -> int:
+        self.purge_expired()
+        return len(self._data)
+
+    def __bool__(self) -> bool:
+        return len(self) > 0
+
+    def clear(self):
+        self._data.clear()
+
+    def stats(self) -> Dict[str, Any]:
+        self.purge_expired()
+        # грубая (неглубокая) оценка памяти: контейнер + ключи + записи
+        approx = sys.getsizeof(self._data) + sum(
+            sys.getsizeof(k) + sys.getsizeof(e) for k, e in self._data.items())
+        return {"size": len(self._data), "max_size": self.max_size,
+                "evictions": self.evictions, "expirations": self.expirations, "approx_bytes": approx}
+
+_bounded_maps: List[BoundedMap] = []
+
+def _memory_stats() -> Dict[str, Dict[str, Any]]:
+    return {m.name: m.stats() for m in _bounded_maps}
+
+def _on_menu_timer_evicted(key: Tuple[int, int], entry: Tuple[asyncio.Task, float]):
+    # таймер вытеснен — удаляем меню сразу, чтобы оно не повисло навсегда
+    task = entry[0]
+    if task and not task.done():
+        task.cancel()
+    _enqueue_delete(key[0], key[1])
+
 # ========= In-memory state =========
 last_twitch_stream_id: Optional[str] = None
 _tw_token: Optional[str] = None
 _tw_token_expire_at: int = 0
 _last_called_ts = {"tw": 0}
 
-# Личное якорное меню: (chat_id, user_id) -> message_id
-_user_menu_anchor: Dict[Tuple[int, int], int] = {}
-# Таймеры на удаление меню: (chat_id, message_id) -> task
-_menu_timers: Dict[Tuple[int, int], asyncio.Task] = {}
+# Личное якорное меню: (chat_id, user_id) -> message_id (живёт не дольше пары TTL меню)
+_user_menu_anchor = BoundedMap("menu_anchor", max_size=5000, ttl=MENU_TTL_SECONDS * 2)
+# Таймеры на удаление меню: (chat_id, message_id) -> (task, срок удаления по time.time())
+_menu_timers = BoundedMap("menu_timers", max_size=5000, on_evict=_on_menu_timer_evicted)
 
 # Ежечасные напоминания по лайву
 _live_reminder_task: Optional[asyncio.Task] = None
-_live_last_msg_by_chat: Dict[int | str, int] = {}
+_live_last_msg_by_chat = BoundedMap("live_last_msg", max_size=64)
 _last_youtube_live_id: Optional[str] = None
 
-# Антидубль для дневных напоминаний
-_posted_daily_keys: set[str] = set()
+# Очередь на удаление: chat_id -> [message_id, ...] (сбрасывается пачками через deleteMessages)
+_delete_queue: Dict[int | str, List[int]] = {}
+# deleteMessages молча пропускает id, которые удалить нельзя, поэтому по пачке известен только итог вызова;
+# поштучный итог — только там, где удаляли по одному (фоллбек после отказа пачки)
+_delete_stats: Dict[str, int] = {"queued": 0, "api_calls": 0, "batches_ok": 0, "batch_ids_accepted": 0,
+                                 "batches_failed": 0, "single_ok": 0, "single_failed": 0,
+                                 "requeued": 0, "dropped": 0}
+# Итог по каждому вызову: (ts, chat_id, "batch"/"single", [message_id, ...], ok, ошибка)
+_delete_log: deque = deque(maxlen=500)
+# Сколько раз id уже возвращался в очередь после временного сбоя: (chat_id, message_id) -> n
+_delete_attempts: Dict[Tuple[int | str, int], int] = {}
+
+# Антидубль для дневных напоминаний (ключ «YYYY-MM-DD HH:MM» нужен только в течение суток)
+_posted_daily_keys = BoundedMap("daily_keys", max_size=64, ttl=2 * 86400)
+
+# Кэш задач Google Tasks: версия растёт при каждом успешном обновлении
+_tasks_cache: Dict[str, object] = {"items": [], "ts": 0.0, "ver": 0, "digest": None}
+_tasks_cache_lock: Optional[asyncio.Lock] = None
+# Индекс для инлайн-запросов: пересобирается при смене версии задач или даты
+_schedule_index: Dict[str, object] = {"key": None, "today": "", "week": "", "days": {}}
+# Готовые тела фидов: пересобираются при смене версии задач
+_feed_cache: Dict[str, object] = {"ver": None, "ics": b"", "json": b"", "etag_ics": "", "etag_json": ""}
+# Пререндер недель месяца: (year, month, idx) -> (ver, text, kb)
+_month_render_cache = BoundedMap("month_render", max_size=256)
+
+# Фоновые задачи (сильные ссылки + аккуратная отмена при остановке) и флаг приёма апдейтов
+_background_tasks: set[asyncio.Task] = set()
+# Задачи «по ключу» (_spawn_once): ключ -> идущая задача
+_keyed_tasks: Dict[Hashable, asyncio.Task] = {}
+_accepting_updates = True
 
 # ==================== УТИЛИТЫ ====================
 def now_local() -> datetime:
@@ -140,6 +404,302 @@ def html_escape(s: str) -> str:
 def _ids_or_default(custom: List[int | str]) -> List[int | str]:
     return custom if custom else CHAT_IDS
 
+def _create_detached_task(coro) -> asyncio.Task:
+    """
+    create_task без трассы текущего апдейта: задача копирует контекст и иначе дописывала бы спаны
+    в трассу, которая уже закрыта и лежит в _recent_traces.
+    """
+    ctx = contextvars.copy_context()
+    ctx.run(_current_trace.set, None)
+    return asyncio.create_task(coro, context=ctx)
+
+def _spawn(coro) -> asyncio.Task:
+    """
+    Фоновая задача: держим сильную ссылку, пока она идёт (asyncio хранит только слабую —
+    иначе GC может собрать её на ходу), и отменяем при остановке бота.
+    """
+    task = _create_detached_task(coro)
+    _background_tasks.add(task)
+    task.add_done_callback(_background_tasks.discard)
+    return task
+
+def _spawn_once(key: Hashable, coro) -> asyncio.Task:
+    """Как _spawn, но не больше одной задачи на ключ: пока идёт прежняя, новая не запускается."""
+    running = _keyed_tasks.get(key)
+    if running is not None and not running.done():
+        coro.close()
+        return running
+    task = _spawn(coro)
+    _keyed_tasks[key] = task
+
+    def _forget(t: asyncio.Task):
+        if _keyed_tasks.get(key) is t:
+            del _keyed_tasks[key]
+    task.add_done_callback(_forget)
+    return task
+
+# ==================== ТРАССИРОВКА И ПРОФИЛИРОВАНИЕ ====================
+class _Trace:
+    __slots__ = ("label", "started", "started_perf", "duration", "spans")
+
+    def __init__(self, label: str):
+        self.label = label
+        self.started = time.time()
+        self.started_perf = time.perf_counter()
+        self.duration = 0.0
+        self.spans: List[Tuple[str, float, float]] = []  # (имя, смещение от начала, длительность)
+
+# Трасса текущего апдейта; копируется в asyncio.to_thread вместе с контекстом
+_current_trace: contextvars.ContextVar[Optional[_Trace]] = contextvars.ContextVar("current_trace", default=None)
+_recent_traces: deque = deque(maxlen=TRACE_RECENT_MAX)
+_profile_lock = threading.Lock()
+
+class _span:
+    """with _span("google.tasks"): ... — замер участка, если идёт трасса апдейта; иначе почти ноль работы."""
+    __slots__ = ("name", "trace", "t0")
+
+    def __init__(self, name: str):
+        self.name = name
+        self.trace = _current_trace.get()
+
+    def __enter__(self):
+        if self.trace is not None:
+            self.t0 = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        tr = self.trace
+        if tr is not None:
+            t1 = time.perf_counter()
+            tr.spans.append((self.name, self.t0 - tr.started_perf, t1 - self.t0))
+        return False
+
+def _traced(name: str):
+    def deco(fn):
+        @functools.wraps(fn)
+        def wrapper(*args, **kwargs):
+            if _current_trace.get() is None:
+                return fn(*args, **kwargs)
+            with _span(name):
+                return fn(*args, **kwargs)
+        return wrapper
+    return deco
+
+def _update_label(update: object) -> str:
+    if not isinstance(update, Update):
+        return type(update).__name__
+    if update.callback_query:
+        return f"cb:{(update.callback_query.data or '')[:32]}"
+    if update.inline_query:
+        return "inline"
+    msg = update.effective_message
+    if msg and msg.text:
+        return f"cmd:{msg.text.split()[0][:32]}" if msg.text.startswith("/") else "text"
+    return "update"
+
+def _slowest_traces(limit: int = TRACE_SLOWEST_SHOW) -> List[dict]:
+    out = sorted(list(_recent_traces), key=lambda t: t.duration, reverse=True)[:limit]
+    return [{
+        "label": t.label,
+        "at": datetime.fromtimestamp(t.started, timezone.utc).isoformat(),
+        "ms": round(t.duration * 1000, 1),
+        "spans": [{"name": n, "at_ms": round(off * 1000, 1), "ms": round(d * 1000, 1)} for n, off, d in t.spans],
+    } for t in out]
+
+class _TracedRequest(HTTPXRequest):
+    """HTTP-слой Bot API: каждый вызов (sendMessage, editMessageText, ...) — отдельный спан."""
+
+    async def do_request(self, url: str, method: str, *args, **kwargs):
+        if _current_trace.get() is None:
+            return await super().do_request(url, method, *args, **kwargs)
+        with _span("tg." + url.rsplit("/", 1)[-1]):
+            return await super().do_request(url, method, *args, **kwargs)
+
+def _sample_stacks(seconds: float, interval: float = PROFILE_INTERVAL_SECONDS) -> Dict[str, int]:
+    """Сэмплирующий профилировщик: раз в interval снимаем стеки всех потоков, копим collapsed-формат."""
+    me = threading.get_ident()
+    names = {t.ident: t.name for t in threading.enumerate()}
+    counts: Dict[str, int] = {}
+    deadline = time.monotonic() + seconds
+    while time.monotonic() < deadline:
+        for ident, frame in sys._current_frames().items():
+            if ident == me:
+                continue
+            stack = []
+            f = frame
+            while f is not None:
+                co = f.f_code
+                stack.append(f"{co.co_name} ({os.path.basename(co.co_filename)}:{co.co_firstlineno})")
+                f = f.f_back
+            key = names.get(ident, str(ident)) + ";" + ";".join(reversed(stack))
+            counts[key] = counts.get(key, 0) + 1
+        time.sleep(interval)
+    return counts
+
+# ==================== УСТОЙЧИВОСТЬ: РЕТРАИ И CIRCUIT BREAKER ====================
+class CircuitOpenError(Exception):
+    """Сервис помечен как недоступный — вызов отклонён без обращения к сети."""
+
+class CircuitBreaker:
+    """
+    closed -> (threshold неудач подряд) -> open -> (reset_seconds) -> half-open:
+    пропускаем один пробный вызов; успех замыкает цепь, неудача снова размыкает.
+    """
+
+    def __init__(self, name: str, threshold: int = BREAKER_FAILURE_THRESHOLD,
+                 reset_seconds: float = BREAKER_RESET_SECONDS):
+        self.name = name
+        self.threshold = threshold
+        self.reset_seconds = reset_seconds
+        self.failures = 0
+        self.opened_at = 0.0
+        self.half_open_probe = False
+        self._lock = threading.Lock()  # вызовы идут и из потоков (asyncio.to_thread)
+
+    @property
+    def state(self) -> str:
+        if self.failures < self.threshold:
+            return "closed"
+        if time.monotonic() - self.opened_at >= self.reset_seconds:
+            return "half-open"
+        return "open"
+
+    def _acquire(self) -> Optional[bool]:
+        """None — вызов запрещён; True — это пробный вызов half-open; False — обычный."""
+        with self._lock:
+            st = self.state
+            if st == "closed":
+                return False
+            if st == "half-open" and not self.half_open_probe:
+                self.half_open_probe = True
+                return True
+            return None
+
+    def allow(self) -> bool:
+        return self._acquire() is not None
+
+    def release_probe(self):
+        """Пробный вызов закончился без вердикта (429, RetryAfter, неожиданное исключение) — пустить следующий."""
+        with self._lock:
+            self.half_open_probe = False
+
+    @contextlib.contextmanager
+    def guard(self):
+        """
+        with br.guard(): ... — одна попытка вызова через breaker. Если это пробный вызов half-open,
+        проба освобождается на любом выходе, иначе breaker навсегда остался бы в half-open.
+        """
+        probe = self._acquire()
+        if probe is None:
+            raise CircuitOpenError(self.name)
+        try:
+            yield
+        finally:
+            if probe:
+                self.release_probe()
+
+    def record_success(self):
+        with self._lock:
+            if self.failures >= self.threshold:
+                print(f"[BREAKER] {self.name}: closed")
+            self.failures = 0
+            self.half_open_probe = False
+
+    def record_failure(self):
+        with self._lock:
+            self.failures += 1
+            self.half_open_probe = False
+            if self.failures >= self.threshold:
+                if self.failures == self.threshold:
+                    print(f"[BREAKER] {self.name}: open for {self.reset_seconds}s")
+                self.opened_at = time.monotonic()
+
+_breakers: Dict[str, CircuitBreaker] = {
+    name: CircuitBreaker(name) for name in ("telegram", "google", "twitch", "youtube")
+}
+
+def _backoff_delay(attempt: int) -> float:
+    """Экспоненциальная задержка с «полным» джиттером: random(0, base * 2^(attempt-1))."""
+    return random.uniform(0, min(RETRY_MAX_DELAY_SECONDS, RETRY_BASE_DELAY_SECONDS * (2 ** (attempt - 1))))
+
+def _retry_after_seconds(resp: requests.Response) -> Optional[float]:
+    raw = resp.headers.get("Retry-After")
+    if not raw:
+        return None
+    try:
+        return max(0.0, float(raw))
+    except ValueError:
+        return None
+
+def _http_request(upstream: str, method: str, url: str, attempts: int = RETRY_ATTEMPTS,
+                  **kwargs) -> requests.Response:
+    """
+    Синхронный HTTP-вызов внешнего API с ретраями (сеть, 429, 5xx), учётом Retry-After
+    и circuit breaker на upstream. 4xx (кроме 429) не ретраим — сразу raise_for_status().
+    Вызывать из потока (asyncio.to_thread), т.к. ждёт через time.sleep.
+    """
+    br = _breakers[upstream]
+    kwargs.setdefault("timeout", HTTP_TIMEOUT_SECONDS)
+    span_name = f"{upstream}.{url.split('?', 1)[0].rsplit('/', 1)[-1]}"
+    for attempt in range(1, attempts + 1):
+        with br.guard():
+            try:
+                with _span(span_name):
+                    r = requests.request(method, url, **kwargs)
+            except (requests.ConnectionError, requests.Timeout):
+                br.record_failure()
+                if attempt == attempts:
+                    raise
+                r = None
+            if r is None:
+                delay = _backoff_delay(attempt)
+            elif r.status_code != 429 and r.status_code < 500:
+                br.record_success()
+                r.raise_for_status()
+                return r
+            else:
+                # 429 — нас притормозили, сервис жив; 5xx — считаем сбоем
+                if r.status_code >= 500:
+                    br.record_failure()
+                delay = _retry_after_seconds(r)
+                if delay is None:
+                    delay = _backoff_delay(attempt)
+                if attempt == attempts or delay > RETRY_MAX_DELAY_SECONDS:
+                    r.raise_for_status()
+        # ждём уже вне guard: пробный вызов не держим на время паузы
+        time.sleep(delay)
+    raise RuntimeError("unreachable")
+
+async def _tg_call(fn, *args, idempotent: bool = True, attempts: int = RETRY_ATTEMPTS, **kwargs):
+    """
+    Вызов Bot API с ретраями: RetryAfter — ждём ровно сколько сказал Telegram,
+    сетевые ошибки/таймауты — экспоненциальный бэкофф. TimedOut у неидемпотентных
+    вызовов (send_*) не повторяем, чтобы не задвоить пост. BadRequest/Forbidden — сразу наверх.
+    """
+    br = _breakers["telegram"]
+    for attempt in range(1, attempts + 1):
+        with br.guard():
+            try:
+                res = await fn(*args, **kwargs)
+                br.record_success()
+                return res
+            except (BadRequest, Forbidden):
+                br.record_success()  # API ответил — значит, жив
+                raise
+            except RetryAfter as e:
+                delay = float(e.retry_after)
+                if attempt == attempts or delay > RETRY_MAX_DELAY_SECONDS:
+                    raise
+                print(f"[TG] flood wait {delay:.0f}s (attempt {attempt}/{attempts})")
+                delay += 0.1
+            except (TimedOut, NetworkError) as e:
+                br.record_failure()
+                if attempt == attempts or (isinstance(e, TimedOut) and not idempotent):
+                    raise
+                delay = _backoff_delay(attempt)
+        await asyncio.sleep(delay)
+    raise RuntimeError("unreachable")
+
 # ==================== TELEGRAM UI ====================
 def main_reply_kb() -> ReplyKeyboardMarkup:
     return ReplyKeyboardMarkup([[KeyboardButton(KB_LABEL)]],
@@ -148,7 +708,9 @@ def main_reply_kb() -> ReplyKeyboardMarkup:
 async def _send_service_message(app: Application, chat_id: int | str, text: str,
                                 reply_markup=None) -> Optional[Message]:
     try:
-        return await app.bot.send_message(
+        return await _tg_call(
+            app.bot.send_message,
+            idempotent=False,
             chat_id=chat_id,
             text=text,
             reply_markup=reply_markup,
@@ -158,54 +720,289 @@ async def _send_service_message(app: Application, chat_id: int | str, text: str,
         print(f"[SERVICE] send failed to {chat_id}: {e}")
         return None
 
+# ==================== РЕЕСТР ЧАТОВ ====================
+class ChatInfo:
+    """Что известно о целевом чате: числовой id, тип и может ли бот слать туда фото."""
+    __slots__ = ("ref", "chat_id", "type", "reachable", "can_send_photos", "slow_mode_delay",
+                 "photo_failed_urls", "resolved_at")
+
+    def __init__(self, ref: int | str):
+        self.ref = ref
+        self.chat_id: Optional[int] = None
+        self.type: Optional[str] = None
+        self.reachable = True               # False — get_chat ответил «нет доступа/нет чата»
+        self.can_send_photos: Optional[bool] = None
+        self.slow_mode_delay = 0
+        self.photo_failed_urls: set[str] = set()  # фото по этим URL здесь уже не прошло
+        self.resolved_at = 0.0
+
+# str(тег или id из конфига) -> ChatInfo
+_chat_registry: Dict[str, ChatInfo] = {}
+
+def _chat_info(ref: int | str) -> Optional[ChatInfo]:
+    return _chat_registry.get(str(ref))
+
+def _resolved_chat_id(ref: int | str) -> int | str:
+    info = _chat_info(ref)
+    return info.chat_id if info and info.chat_id is not None else ref
+
+def _all_target_chats() -> List[int | str]:
+    return list(dict.fromkeys(CHAT_IDS + ANNOUNCE_CHAT_IDS + TEST_ANNOUNCE_CHAT_IDS
+                              + LIVE_REMINDER_CHAT_IDS + SCHEDULE_REMINDER_CHAT_IDS))
+
+async def _resolve_chat(app: Application, ref: int | str) -> ChatInfo:
+    info = _chat_registry.get(str(ref)) or ChatInfo(ref)
+    try:
+        chat = await _tg_call(app.bot.get_chat, chat_id=ref)
+        member = await _tg_call(app.bot.get_chat_member, chat_id=chat.id, user_id=app.bot.id)
+    except (BadRequest, Forbidden) as e:
+        print(f"[CHATS] {ref} unreachable: {e}")
+        info.reachable = False
+        info.resolved_at = time.time()
+        _chat_registry[str(ref)] = info
+        return info
+    info.chat_id = chat.id
+    info.type = chat.type
+    info.reachable = True
+    info.slow_mode_delay = int(getattr(chat, "slow_mode_delay", 0) or 0)
+    if member.status in ("creator", "administrator"):
+        # в канале постить может только админ с can_post_messages; в группе админу можно всё
+        info.can_send_photos = (chat.type != "channel") or member.status == "creator" \
+            or bool(getattr(member, "can_post_messages", False))
+    elif member.status == "restricted":
+        info.can_send_photos = bool(getattr(member, "can_send_photos", False))
+    elif member.status in ("left", "kicked"):
+        info.can_send_photos = False
+    else:
+        perms = getattr(chat, "permissions", None)
+        info.can_send_photos = chat.type != "channel" and (perms is None or perms.can_send_photos is not False)
+    info.photo_failed_urls.clear()
+    info.resolved_at = time.time()
+    _chat_registry[str(ref)] = info
+    return info
+
+async def _chat_registry_refresh(app: Application):
+    for ref in _all_target_chats():
+        try:
+            info = await _resolve_chat(app, ref)
+            if info.reachable:
+                print(f"[CHATS] {ref} -> {info.chat_id} type={info.type} photos={info.can_send_photos} "
+                      f"slow_mode={info.slow_mode_delay}s")
+        except Exception as e:
+            # сеть/лимиты — оставляем прежние данные, попробуем при следующем обновлении
+            print(f"[CHATS] resolve {ref} failed: {e}")
+
+async def _chat_registry_loop(app: Application):
+    while True:
+        await asyncio.sleep(max(60, CHAT_REGISTRY_REFRESH_MIN * 60))
+        await _chat_registry_refresh(app)
+
+# ==================== ОЧЕРЕДЬ УДАЛЕНИЯ СООБЩЕНИЙ ====================
+def _enqueue_delete(chat_id: int | str, message_id: Optional[int]):
+    """Поставить сообщение в очередь на удаление (фактически удаляется пачкой в _delete_flush_loop)."""
+    if not message_id:
+        return
+    ids = _delete_queue.setdefault(chat_id, [])
+    if message_id not in ids:
+        ids.append(message_id)
+        _delete_stats["queued"] += 1
+
+def _requeue_deletes(chat_id: int | str, ids: List[int], err: str):
+    """Временный сбой: вернуть id в очередь до следующего сброса (не больше DELETE_MAX_ATTEMPTS раз)."""
+    ids_q = _delete_queue.setdefault(chat_id, [])
+    for mid in ids:
+        n = _delete_attempts.get((chat_id, mid), 0) + 1
+        if n >= DELETE_MAX_ATTEMPTS:
+            _delete_attempts.pop((chat_id, mid), None)
+            _delete_stats["dropped"] += 1
+            print(f"[DEL] give up on {chat_id}/{mid} after {n} attempts: {err}")
+            continue
+        _delete_attempts[(chat_id, mid)] = n
+        if mid not in ids_q:
+            ids_q.append(mid)
+            _delete_stats["requeued"] += 1
+    if not ids_q:
+        _delete_queue.pop(chat_id, None)
+
+def _delete_done(chat_id: int | str, ids: List[int]):
+    for mid in ids:
+        _delete_attempts.pop((chat_id, mid), None)
+
+async def _delete_one(app: Application, chat_id: int | str, message_id: int):
+    _delete_stats["api_calls"] += 1
+    try:
+        await _tg_call(app.bot.delete_message, chat_id=chat_id, message_id=message_id)
+    except (BadRequest, Forbidden) as e:
+        # уже удалено, старше 48 ч, нет прав — повтор не поможет
+        _delete_stats["single_failed"] += 1
+        _delete_log.append((time.time(), chat_id, "single", [message_id], False, str(e)))
+        _delete_done(chat_id, [message_id])
+        return
+    except Exception as e:
+        _requeue_deletes(chat_id, [message_id], str(e))
+        return
+    _delete_stats["single_ok"] += 1
+    _delete_log.append((time.time(), chat_id, "single", [message_id], True, None))
+    _delete_done(chat_id, [message_id])
+
+async def _flush_delete_queue(app: Application):
+    if not _delete_queue:
+        return
+    pending = dict(_delete_queue)
+    _delete_queue.clear()
+    for chat_id, ids in pending.items():
+        for i in range(0, len(ids), DELETE_BATCH_MAX):
+            batch = ids[i:i + DELETE_BATCH_MAX]
+            try:
+                _delete_stats["api_calls"] += 1
+                await _tg_call(app.bot.delete_messages, chat_id=chat_id, message_ids=batch)
+            except Forbidden as e:
+                # бота выгнали из чата или лишили прав — поштучно будет тот же отказ; остаток чата снимаем
+                rest = ids[i:]
+                print(f"[DEL] deleteMessages forbidden in {chat_id}: {e} -> drop {len(rest)} ids")
+                _delete_stats["batches_failed"] += 1
+                _delete_stats["dropped"] += len(rest)
+                _delete_log.append((time.time(), chat_id, "batch", rest, False, str(e)))
+                _delete_done(chat_id, rest)
+                break
+            except BadRequest as e:
+                # пачку отклонили целиком — удаляем по одному, чтобы не потерять удалимые и знать итог каждого
+                print(f"[DEL] deleteMessages rejected in {chat_id} ({len(batch)} ids): {e} -> one by one")
+                _delete_stats["batches_failed"] += 1
+                _delete_log.append((time.time(), chat_id, "batch", batch, False, str(e)))
+                for mid in batch:
+                    await _delete_one(app, chat_id, mid)
+                continue
+            except Exception as e:
+                print(f"[DEL] deleteMessages failed in {chat_id} ({len(batch)} ids): {e} -> retry later")
+                _delete_stats["batches_failed"] += 1
+                _delete_log.append((time.time(), chat_id, "batch", batch, False, str(e)))
+                _requeue_deletes(chat_id, batch, str(e))
+                continue
+            _delete_stats["batches_ok"] += 1
+            _delete_stats["batch_ids_accepted"] += len(batch)
+            _delete_log.append((time.time(), chat_id, "batch", batch, True, None))
+            _delete_done(chat_id, batch)
+
+async def _delete_flush_loop(app: Application):
+    print("[DEL] flush loop started")
+    while True:
+        try:
+            await asyncio.sleep(DELETE_FLUSH_INTERVAL_SECONDS)
+            await _flush_delete_queue(app)
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            print(f"[DEL] loop error: {e}")
+
 # ==================== GOOGLE TASKS ====================
+def _tasks_env_ok() -> bool:
+    return bool(GOOGLE_TASKS_CLIENT_ID and GOOGLE_TASKS_CLIENT_SECRET and GOOGLE_TASKS_REFRESH_TOKEN and GOOGLE_TASKS_LIST_ID)
+
+def _tasks_get_access_token_strict() -> str:
+    r = _http_request(
+        "google", "POST",
+        "https://oauth2.googleapis.com/token",
+        data={
+            "client_id": GOOGLE_TASKS_CLIENT_ID,
+            "client_secret": GOOGLE_TASKS_CLIENT_SECRET,
+            "refresh_token": GOOGLE_TASKS_REFRESH_TOKEN,
+            "grant_type": "refresh_token",
+        },
+    )
+    token = _json_loads(r.content).get("access_token")
+    if not token:
+        raise RuntimeError("no access_token in OAuth response")
+    return token
+
 def _tasks_get_access_token() -> Optional[str]:
-    if not (GOOGLE_TASKS_CLIENT_ID and GOOGLE_TASKS_CLIENT_SECRET and GOOGLE_TASKS_REFRESH_TOKEN and GOOGLE_TASKS_LIST_ID):
+    if not _tasks_env_ok():
         print("[TASKS] Missing env: CLIENT_ID/SECRET/REFRESH_TOKEN/LIST_ID")
         return None
     try:
-        r = requests.post(
-            "https://oauth2.googleapis.com/token",
-            data={
-                "client_id": GOOGLE_TASKS_CLIENT_ID,
-                "client_secret": GOOGLE_TASKS_CLIENT_SECRET,
-                "refresh_token": GOOGLE_TASKS_REFRESH_TOKEN,
-                "grant_type": "refresh_token",
-            },
-            timeout=20,
-        )
-        r.raise_for_status()
-        return r.json().get("access_token")
+        return _tasks_get_access_token_strict()
     except Exception as e:
         print(f"[TASKS] token error: {e}")
         return None
 
-def _tasks_fetch_all() -> List[dict]:
-    token = _tasks_get_access_token()
-    if not token:
+def _tasks_fetch_all_strict() -> List[dict]:
+    """Все задачи списка; любая ошибка (в т.ч. CircuitOpenError) пробрасывается наружу."""
+    if not _tasks_env_ok():
         return []
+    token = _tasks_get_access_token_strict()
     items: List[dict] = []
     page_token = None
+    while True:
+        params = {"showCompleted": "false", "showDeleted": "false", "maxResults": "100"}
+        if page_token:
+            params["pageToken"] = page_token
+        r = _http_request(
+            "google", "GET",
+            f"https://tasks.googleapis.com/tasks/v1/lists/{GOOGLE_TASKS_LIST_ID}/tasks",
+            headers={"Authorization": f"Bearer {token}"},
+            params=params,
+        )
+        data = _json_loads(r.content) or {}
+        items.extend(data.get("items", []))
+        page_token = data.get("nextPageToken")
+        if not page_token:
+            break
+    return items
+
+def _tasks_fetch_all() -> List[dict]:
+    if not _tasks_env_ok():
+        print("[TASKS] Missing env: CLIENT_ID/SECRET/REFRESH_TOKEN/LIST_ID")
+        return []
     try:
-        while True:
-            params = {"showCompleted": "false", "showDeleted": "false", "maxResults": "100"}
-            if page_token:
-                params["pageToken"] = page_token
-            r = requests.get(
-                f"https://tasks.googleapis.com/tasks/v1/lists/{GOOGLE_TASKS_LIST_ID}/tasks",
-                headers={"Authorization": f"Bearer {token}"},
-                params=params,
-                timeout=20,
-            )
-            r.raise_for_status()
-            data = r.json() or {}
-            items.extend(data.get("items", []))
-            page_token = data.get("nextPageToken")
-            if not page_token:
-                break
+        return _tasks_fetch_all_strict()
     except Exception as e:
         print(f"[TASKS] fetch error: {e}")
-    return items
+        return []
+
+async def _tasks_get_cached(max_age: float = TASKS_CACHE_TTL_SECONDS) -> List[dict]:
+    """
+    Список задач из кэша; если он старше max_age — перезапрос (один на всех ожидающих).
+    Если Google недоступен — отдаём последний удачный список, не затирая его пустым.
+    """
+    global _tasks_cache_lock
+    if time.time() - float(_tasks_cache["ts"]) < max_age:
+        return _tasks_cache["items"]  # type: ignore[return-value]
+    if _tasks_cache_lock is None:
+        _tasks_cache_lock = asyncio.Lock()
+    async with _tasks_cache_lock:
+        # пока ждали лок, кэш мог обновить другой запрос
+        if time.time() - float(_tasks_cache["ts"]) < max_age:
+            return _tasks_cache["items"]  # type: ignore[return-value]
+        try:
+            items = await asyncio.to_thread(_tasks_fetch_all_strict)
+        except Exception as e:
+            print(f"[TASKS] fetch error (serving cached): {e}")
+            return _tasks_cache["items"]  # type: ignore[return-value]
+        _tasks_cache["ts"] = time.time()
+        # версия растёт, только если расписание реально поменялось — от неё зависят все кэши рендеров
+        digest = _tasks_digest(items)
+        if digest != _tasks_cache["digest"]:
+            _tasks_cache["items"] = items
+            _tasks_cache["digest"] = digest
+            _tasks_cache["ver"] = int(_tasks_cache["ver"]) + 1
+            _month_render_cache.clear()
+        return _tasks_cache["items"]  # type: ignore[return-value]
+
+async def _tasks_snapshot() -> List[dict]:
+    """
+    Задачи для ответов, которые не должны ждать Google (инлайн, фиды): устаревший кэш отдаём как есть,
+    а обновление запускаем фоном. Ждём только самый первый раз, пока кэш ещё пуст.
+    """
+    if int(_tasks_cache["ver"]) == 0:
+        return await _tasks_get_cached()
+    if time.time() - float(_tasks_cache["ts"]) >= TASKS_CACHE_TTL_SECONDS:
+        _spawn_once("tasks_refresh", _tasks_get_cached())
+    return _tasks_cache["items"]  # type: ignore[return-value]
+
+def _tasks_digest(items: List[dict]) -> str:
+    """Отпечаток значимых для расписания полей (id, title, due) — для сравнения результатов синхронизации."""
+    rows = sorted((t.get("id") or "", t.get("title") or "", t.get("due") or "") for t in items)
+    return hashlib.sha256(json.dumps(rows, ensure_ascii=False).encode("utf-8")).hexdigest()
 
 _time_re = re.compile(r"(^|\s)(\d{1,2}):(\d{2})(\b)")
 _mention_re = re.compile(r"@\w+")
@@ -252,10 +1049,14 @@ def _weekday_abr(d: date) -> str:
     ru_days = ["Пн", "Вт", "Ср", "Чт", "Пт", "Сб", "Вс"]
     return ru_days[d.weekday()]
 
-def _format_today_plain(tasks: List[dict], d: date) -> str:
-    header = f"📅 Стримы сегодня — {d.strftime('%d.%m.%Y')}"
+@_traced("render.today")
+def _format_today_plain(tasks: List[dict], d: date, is_today: bool = True) -> str:
+    if is_today:
+        header = f"📅 Стримы сегодня — {d.strftime('%d.%m.%Y')}"
+    else:
+        header = f"📅 Стримы {_weekday_abr(d)} — {d.strftime('%d.%m.%Y')}"
     if not tasks:
-        return f"{header}\n\nСегодня стримов нет."
+        return f"{header}\n\n{'Сегодня стримов нет.' if is_today else 'Стримов нет.'}"
     lines = [header, ""]
     tasks_sorted = sorted(tasks, key=lambda t: (_extract_time_from_title(t.get("title") or "")[0] or "99:99"))
     for t in tasks_sorted:
@@ -267,6 +1068,7 @@ def _format_today_plain(tasks: List[dict], d: date) -> str:
     lines.append("\nЗалетай на стримчики! 🔥")
     return "\n".join(lines)
 
+@_traced("render.table")
 def _format_table_for_range(tasks: List[dict], start: date, end: date, title: str) -> str:
     m = _tasks_by_date_map(tasks)
     lines = [html_escape(title), "", "<pre>", "Дата     Дн  Время  Событие", "------- ---- ------ ------------"]
@@ -304,26 +1106,24 @@ def _yt_fetch_live_once() -> Optional[dict]:
     if not (YT_API_KEY and YT_CHANNEL_ID):
         return None
     try:
-        r = requests.get(
+        r = _http_request(
+            "youtube", "GET",
             "https://www.googleapis.com/youtube/v3/search",
             params={"part": "snippet", "channelId": YT_CHANNEL_ID, "eventType": "live", "type": "video",
                     "maxResults": 1, "order": "date", "key": YT_API_KEY},
-            timeout=20,
         )
-        r.raise_for_status()
-        items = r.json().get("items", [])
+        items = _json_loads(r.content).get("items", [])
         if not items:
             return None
         video_id = items[0]["id"]["videoId"]
         _last_youtube_live_id = video_id
         yt_title = items[0]["snippet"].get("title") or "LIVE on YouTube"
-        r2 = requests.get(
+        r2 = _http_request(
+            "youtube", "GET",
             "https://www.googleapis.com/youtube/v3/videos",
             params={"part": "snippet", "id": video_id, "key": YT_API_KEY, "maxResults": 1},
-            timeout=20,
         )
-        r2.raise_for_status()
-        vitems = r2.json().get("items", [])
+        vitems = _json_loads(r2.content).get("items", [])
         thumb_url = None
         if vitems:
             thumbs = (vitems[0].get("snippet") or {}).get("thumbnails") or {}
@@ -335,7 +1135,7 @@ def _yt_fetch_live_once() -> Optional[dict]:
     except requests.HTTPError as e:
         code = getattr(e.response, "status_code", "?")
         try:
-            body = e.response.json()
+            body = _json_loads(e.response.content)
         except Exception:
             body = getattr(e.response, "text", "")
         print(f"[YT] HTTP {code}: {body}")
@@ -344,12 +1144,16 @@ def _yt_fetch_live_once() -> Optional[dict]:
     return None
 
 async def yt_fetch_live_with_retries(max_attempts: int = 3, delay_seconds: int = 10) -> Optional[dict]:
+    """Ждём появления эфира на YouTube: паузы растут экспоненциально (с джиттером); при «лежащем» API — сразу None."""
     for attempt in range(1, max_attempts + 1):
-        res = _yt_fetch_live_once()
+        res = await asyncio.to_thread(_yt_fetch_live_once)
         if res:
             return res
+        if _breakers["youtube"].state == "open":
+            return None
         if attempt < max_attempts:
-            await asyncio.sleep(delay_seconds)
+            delay = min(RETRY_MAX_DELAY_SECONDS, delay_seconds * (2 ** (attempt - 1)))
+            await asyncio.sleep(random.uniform(delay / 2, delay))
     return None
 
 # ==================== TWITCH ====================
@@ -362,13 +1166,12 @@ def _tw_fetch_token() -> Optional[str]:
     if _tw_token and now_ts < _tw_token_expire_at - 60:
         return _tw_token
     try:
-        r = requests.post(
+        r = _http_request(
+            "twitch", "POST",
             "https://id.twitch.tv/oauth2/token",
             data={"client_id": TWITCH_CLIENT_ID, "client_secret": TWITCH_CLIENT_SECRET, "grant_type": "client_credentials"},
-            timeout=20,
         )
-        r.raise_for_status()
-        data = r.json()
+        data = _json_loads(r.content)
         _tw_token = data["access_token"]
         _tw_token_expire_at = now_ts + int(data.get("expires_in", 3600))
         return _tw_token
@@ -395,14 +1198,13 @@ def twitch_check_live() -> Optional[dict]:
         return None
 
     def _call() -> Optional[dict]:
-        r = requests.get(
+        r = _http_request(
+            "twitch", "GET",
             "https://api.twitch.tv/helix/streams",
             params={"user_login": TWITCH_USERNAME},
             headers={"Client-ID": TWITCH_CLIENT_ID, "Authorization": f"Bearer {tk}"},
-            timeout=20,
         )
-        r.raise_for_status()
-        data = r.json().get("data", [])
+        data = _json_loads(r.content).get("data", [])
         if not data:
             return None
         s = data[0]
@@ -423,6 +1225,9 @@ def twitch_check_live() -> Optional[dict]:
             _tw_token = None
             _tw_token_expire_at = 0
             try:
+                tk = _tw_fetch_token()
+                if not tk:
+                    return None
                 res = _call()
                 if res:
                     last_twitch_stream_id = res["id"]
@@ -444,14 +1249,13 @@ def twitch_is_live() -> bool:
     if not tk:
         return False
     try:
-        r = requests.get(
+        r = _http_request(
+            "twitch", "GET",
             "https://api.twitch.tv/helix/streams",
             params={"user_login": TWITCH_USERNAME},
             headers={"Client-ID": TWITCH_CLIENT_ID, "Authorization": f"Bearer {tk}"},
-            timeout=15,
         )
-        r.raise_for_status()
-        data = r.json().get("data", [])
+        data = _json_loads(r.content).get("data", [])
         return bool(data)
     except Exception as e:
         print(f"[TW] is_live error: {e}")
@@ -478,46 +1282,321 @@ def build_announce_kb(youtube_video_id: Optional[str]) -> InlineKeyboardMarkup:
          InlineKeyboardButton("🤙 Вступить в клан", url="https://t.me/D13_join_bot")]
     ])
 
-async def tg_broadcast_photo_first(app: Application, chat_ids: List[int | str], text: str,
-                                   kb: Optional[InlineKeyboardMarkup], photo_url: str,
-                                   silent: bool = False):
-    for chat_id in chat_ids:
+# ==================== СОСТОЯНИЕ (SQLite) ====================
+# Одна база на всё, что должно пережить рестарт; схема создаётся один раз при открытии соединения.
+_STATE_SCHEMA = (
+    # outbox: pending | sending | done | failed
+    "CREATE TABLE IF NOT EXISTS outbox ("
+    " id INTEGER PRIMARY KEY AUTOINCREMENT,"
+    " idem_key TEXT NOT NULL UNIQUE,"
+    " chat_id TEXT NOT NULL,"
+    " payload TEXT NOT NULL,"
+    " status TEXT NOT NULL DEFAULT 'pending',"
+    " attempts INTEGER NOT NULL DEFAULT 0,"
+    " next_at REAL NOT NULL DEFAULT 0,"
+    " created_at REAL NOT NULL,"
+    " message_id INTEGER,"
+    " is_photo INTEGER,"
+    " last_error TEXT)",
+    "CREATE INDEX IF NOT EXISTS outbox_pending ON outbox(status, next_at)",
+    "CREATE TABLE IF NOT EXISTS pinned_schedule (chat TEXT PRIMARY KEY, message_id INTEGER, digest TEXT)",
+    "CREATE TABLE IF NOT EXISTS poll_state (key TEXT PRIMARY KEY, value INTEGER)",
+    "CREATE TABLE IF NOT EXISTS poll_inflight (update_id INTEGER PRIMARY KEY, payload TEXT NOT NULL)",
+    "CREATE TABLE IF NOT EXISTS menu_ttl (chat_id INTEGER, message_id INTEGER, expires_at REAL,"
+    " PRIMARY KEY (chat_id, message_id))",
+    "CREATE TABLE IF NOT EXISTS menu_anchor (chat_id INTEGER, user_id INTEGER, message_id INTEGER,"
+    " PRIMARY KEY (chat_id, user_id))",
+)
+_state_db: Optional[sqlite3.Connection] = None
+
+_DEFAULT_STATE_DB_PATH = "bot_state.sqlite3"
+_LEGACY_STATE_DB_PATH = "outbox.sqlite3"  # имя файла, когда в базе был только outbox
+
+def _migrate_legacy_state_db():
+    # только для пути по умолчанию: явно заданный путь не трогаем
+    if STATE_DB_PATH != _DEFAULT_STATE_DB_PATH:
+        return
+    if os.path.exists(STATE_DB_PATH) or not os.path.exists(_LEGACY_STATE_DB_PATH):
+        return
+    for suffix in ("", "-wal", "-shm"):
+        if os.path.exists(_LEGACY_STATE_DB_PATH + suffix):
+            os.replace(_LEGACY_STATE_DB_PATH + suffix, STATE_DB_PATH + suffix)
+    print(f"[STATE] {_LEGACY_STATE_DB_PATH} -> {STATE_DB_PATH}")
+
+def _state_conn() -> sqlite3.Connection:
+    global _state_db
+    if _state_db is None:
+        _migrate_legacy_state_db()
+        db = sqlite3.connect(STATE_DB_PATH, check_same_thread=False)
+        db.execute("PRAGMA journal_mode=WAL")
+        db.execute("PRAGMA synchronous=NORMAL")
+        for stmt in _STATE_SCHEMA:
+            db.execute(stmt)
+        db.commit()
+        _state_db = db
+    return _state_db
+
+def _state_close():
+    global _state_db
+    if _state_db is not None:
+        _state_db.close()
+        _state_db = None
+
+# ==================== OUTBOX (надёжная доставка рассылок) ====================
+# Каждое сообщение рассылки сначала пишется в SQLite, затем его доставляет пул воркеров.
+# Ключ идемпотентности (UNIQUE) не даёт поставить один и тот же пост дважды, в т.ч. после рестарта.
+# Гарантия — at-least-once: если процесс упал между отправкой и отметкой done, пост уйдёт повторно.
+_outbox_wakeup: Optional[asyncio.Event] = None
+_outbox_waiters: Dict[str, asyncio.Future] = {}
+_outbox_workers: List[asyncio.Task] = []
+
+def _chat_id_to_db(chat_id: int | str) -> str:
+    return str(chat_id)
+
+def _chat_id_from_db(raw: str) -> int | str:
+    return int(raw) if raw.lstrip("-").isdigit() else raw
+
+def _outbox_enqueue(idem_key: str, chat_id: int | str, text: str, kb: Optional[InlineKeyboardMarkup],
+                    photo_url: str, silent: bool) -> bool:
+    """Ставит сообщение в outbox. False — такой ключ уже был (дубль), ничего не добавлено."""
+    payload = json.dumps({
+        "text": text,
+        "kb": kb.to_dict() if kb else None,
+        "photo_url": photo_url,
+        "silent": silent,
+    }, ensure_ascii=False)
+    db = _state_conn()
+    cur = db.execute(
+        "INSERT OR IGNORE INTO outbox (idem_key, chat_id, payload, created_at) VALUES (?, ?, ?, ?)",
+        (idem_key, _chat_id_to_db(chat_id), payload, time.time()),
+    )
+    db.commit()
+    if _outbox_wakeup:
+        _outbox_wakeup.set()
+    return cur.rowcount > 0
+
+def _outbox_claim() -> Optional[tuple]:
+    # Вызывается только из event loop без await внутри — захват атомарен между воркерами
+    db = _state_conn()
+    row = db.execute(
+        "SELECT id, idem_key, chat_id, payload, attempts FROM outbox"
+        " WHERE status = 'pending' AND next_at <= ? ORDER BY id LIMIT 1",
+        (time.time(),),
+    ).fetchone()
+    if row:
+        db.execute("UPDATE outbox SET status = 'sending', attempts = attempts + 1 WHERE id = ?", (row[0],))
+        db.commit()
+    return row
+
+def _outbox_finish(row_id: int, idem_key: str, status: str, msg: Optional[Message] = None,
+                   is_photo: bool = False, error: Optional[str] = None, next_at: float = 0.0):
+    db = _state_conn()
+    db.execute(
+        "UPDATE outbox SET status = ?, message_id = ?, is_photo = ?, last_error = ?, next_at = ? WHERE id = ?",
+        (status, msg.message_id if msg else None, int(is_photo), error, next_at, row_id),
+    )
+    db.commit()
+    if status in ("done", "failed"):
+        fut = _outbox_waiters.pop(idem_key, None)
+        if fut and not fut.done():
+            fut.set_result((msg, is_photo) if status == "done" else None)
+
+async def _deliver_photo_first(app: Application, chat_id: int | str, text: str,
+                               kb: Optional[InlineKeyboardMarkup], photo_url: str,
+                               silent: bool) -> Tuple[Message, bool]:
+    """
+    Фото с подписью; если Telegram фото отклонил (BadRequest) — текст со ссылкой. Возвращает (message, is_photo).
+    По реестру чатов сразу выбираем способ: где фото запрещено или уже падало — шлём текст.
+    Таймаут/сетевая ошибка — не повод для фоллбека (фото могло дойти): ошибка уходит в outbox на повтор.
+    """
+    info = _chat_info(chat_id)
+    if info and not info.reachable:
+        raise Forbidden(f"chat {chat_id} is unreachable (chat registry)")
+    target = _resolved_chat_id(chat_id)
+    try_photo = not (info and (info.can_send_photos is False or photo_url in info.photo_failed_urls))
+    if try_photo:
         try:
-            await app.bot.send_photo(
-                chat_id=chat_id,
+            msg = await _tg_call(
+                app.bot.send_photo,
+                idempotent=False,
+                chat_id=target,
                 photo=photo_url,
                 caption=text,
                 parse_mode="HTML",
                 reply_markup=kb,
                 disable_notification=silent,
             )
-            continue
+            return msg, True
         except BadRequest as e:
             print(f"[TG] photo failed for {chat_id}: {e}. Fallback to link.")
-        except Exception as e:
-            print(f"[TG] photo error to {chat_id}: {e}. Fallback to link.")
+            if info:
+                info.photo_failed_urls.add(photo_url)
+    msg = await _tg_call(
+        app.bot.send_message,
+        idempotent=False,
+        chat_id=target,
+        text=f"{photo_url}\n\n{text}",
+        parse_mode="HTML",
+        reply_markup=kb,
+        disable_notification=silent,
+        disable_web_page_preview=False,
+    )
+    return msg, False
+
+async def _outbox_worker(app: Application, n: int):
+    while True:
         try:
-            await app.bot.send_message(
-                chat_id=chat_id,
-                text=f"{photo_url}\n\n{text}",
-                parse_mode="HTML",
-                reply_markup=kb,
-                disable_notification=silent,
-                disable_web_page_preview=False,
-            )
+            row = _outbox_claim()
+            if not row:
+                _outbox_wakeup.clear()
+                # asyncio.wait, а не wait_for: в 3.11 wait_for может «проглотить» отмену задачи
+                waiter = asyncio.create_task(_outbox_wakeup.wait())
+                try:
+                    await asyncio.wait({waiter}, timeout=5)
+                finally:
+                    waiter.cancel()
+                continue
+            row_id, idem_key, raw_chat, raw_payload, attempts = row
+            chat_id = _chat_id_from_db(raw_chat)
+            p = _json_loads(raw_payload)
+            kb = InlineKeyboardMarkup.de_json(p["kb"], app.bot) if p.get("kb") else None
+            try:
+                msg, is_photo = await _deliver_photo_first(app, chat_id, p["text"], kb, p["photo_url"], p["silent"])
+            except (BadRequest, Forbidden) as e:
+                # чат недоступен/запрещён — повтор не поможет
+                print(f"[OUTBOX] {idem_key} permanently failed: {e}")
+                _outbox_finish(row_id, idem_key, "failed", error=str(e))
+                continue
+            except Exception as e:
+                attempt = attempts + 1
+                # TimedOut: запрос мог дойти — пост, возможно, уже в чате; повтор тем же способом (at-least-once)
+                error = f"uncertain: {e}" if isinstance(e, TimedOut) else str(e)
+                if attempt >= OUTBOX_MAX_ATTEMPTS:
+                    print(f"[OUTBOX] {idem_key} gave up after {attempt} attempts: {error}")
+                    _outbox_finish(row_id, idem_key, "failed", error=error)
+                else:
+                    delay = min(600.0, 5.0 * (2 ** (attempt - 1))) * random.uniform(0.5, 1.0)
+                    print(f"[OUTBOX] {idem_key} attempt {attempt} failed: {error}; retry in {delay:.0f}s")
+                    _outbox_finish(row_id, idem_key, "pending", error=error, next_at=time.time() + delay)
+                continue
+            _outbox_finish(row_id, idem_key, "done", msg=msg, is_photo=is_photo)
+        except asyncio.CancelledError:
+            raise
         except Exception as e:
-            print(f"[TG] message send error to {chat_id}: {e}")
+            print(f"[OUTBOX] worker {n} error: {e}")
+            await asyncio.sleep(1)
+
+def _outbox_start(app: Application):
+    """Поднять воркеры; недоставленные до рестарта записи (pending/sending) продолжают доставляться."""
+    global _outbox_wakeup
+    db = _state_conn()
+    resumed = db.execute("UPDATE outbox SET status = 'pending' WHERE status = 'sending'").rowcount
+    db.execute("DELETE FROM outbox WHERE status IN ('done', 'failed') AND created_at < ?",
+               (time.time() - OUTBOX_KEEP_DONE_DAYS * 86400,))
+    db.commit()
+    pending = db.execute("SELECT COUNT(*) FROM outbox WHERE status = 'pending'").fetchone()[0]
+    print(f"[OUTBOX] started: {OUTBOX_WORKERS} workers, pending={pending} (resumed {resumed})")
+    _outbox_wakeup = asyncio.Event()
+    _outbox_wakeup.set()
+    for n in range(OUTBOX_WORKERS):
+        _outbox_workers.append(asyncio.create_task(_outbox_worker(app, n)))
 
-async def _announce_with_sources(app: Application, title: str, yt_video: Optional[dict]):
-    yt_id = yt_video["id"] if yt_video else None
-    photo_url = (yt_video.get("thumb") if (yt_video and yt_video.get("thumb")) else STATIC_IMAGE_URL)
-    text = (
+async def tg_broadcast_photo_first(app: Application, chat_ids: List[int | str], text: str,
+                                   kb: Optional[InlineKeyboardMarkup], photo_url: str,
+                                   silent: bool = False,
+                                   idem_key: Optional[str] = None) -> List[Tuple[int | str, Message, bool]]:
+    """
+    Рассылка фото с подписью (фоллбек — текст со ссылкой) через outbox.
+    idem_key — ключ рассылки: повторный вызов с тем же ключом ничего не отправит.
+    Ждёт доставки до OUTBOX_WAIT_SECONDS и возвращает [(chat_id, message, is_photo)] доставленных.
+    """
+    base_key = idem_key or f"adhoc:{uuid.uuid4().hex}"
+    loop = asyncio.get_running_loop()
+    futs: List[Tuple[int | str, asyncio.Future]] = []
+    for chat_id in chat_ids:
+        key = f"{base_key}:{chat_id}"
+        if not _outbox_enqueue(key, chat_id, text, kb, photo_url, silent):
+            print(f"[OUTBOX] duplicate {key} -> skip")
+            continue
+        fut = loop.create_future()
+        _outbox_waiters[key] = fut
+        futs.append((chat_id, fut))
+    if not futs:
+        return []
+    await asyncio.wait([f for _, f in futs], timeout=OUTBOX_WAIT_SECONDS)
+    sent: List[Tuple[int | str, Message, bool]] = []
+    for key_chat, fut in futs:
+        if not fut.done():
+            _outbox_waiters.pop(f"{base_key}:{key_chat}", None)
+    for chat_id, fut in futs:
+        if fut.done() and fut.result():
+            msg, is_photo = fut.result()
+            sent.append((chat_id, msg, is_photo))
+    return sent
+
+# Анонс старта стрима
+def _announce_text(title: str) -> str:
+    return (
         "🔴 <b>Стрим начался! Забегай, я тебя жду :)</b>\n\n"
         f"<b>{html_escape(title or '')}</b>\n\n"
         "#DEKTRIAN #D13 #СТРИМ"
     )
+
+async def _announce_with_sources(app: Application, title: str, yt_video: Optional[dict],
+                                 idem_key: Optional[str] = None) -> List[Tuple[int | str, Message, bool]]:
+    yt_id = yt_video["id"] if yt_video else None
+    photo_url = (yt_video.get("thumb") if (yt_video and yt_video.get("thumb")) else STATIC_IMAGE_URL)
+    text = _announce_text(title)
     # Реальный анонс — в канал+группу+тест
-    await tg_broadcast_photo_first(app, ANNOUNCE_CHAT_IDS, text, build_announce_kb(yt_id), photo_url, silent=False)
+    return await tg_broadcast_photo_first(app, ANNOUNCE_CHAT_IDS, text, build_announce_kb(yt_id), photo_url,
+                                          silent=False, idem_key=idem_key)
+
+async def _enrich_announce_with_youtube(app: Application, sent: List[Tuple[int | str, Message, bool]],
+                                        title: str):
+    """
+    Фоном ищем эфир на YouTube и, если нашли, правим уже отправленные анонсы на месте:
+    превью вместо статичной картинки и прямая ссылка на трансляцию в кнопке.
+    """
+    try:
+        yt_live = await yt_fetch_live_with_retries(max_attempts=3, delay_seconds=10)
+    except Exception as e:
+        print(f"[ANNOUNCE] YouTube lookup error: {e}")
+        return
+    if not yt_live:
+        print("[ANNOUNCE] YouTube live not found -> keep Twitch-only announce")
+        return
+    text = _announce_text(title)
+    kb = build_announce_kb(yt_live["id"])
+    thumb = yt_live.get("thumb")
+    for chat_id, msg, is_photo in sent:
+        try:
+            if is_photo and thumb:
+                await _tg_call(
+                    app.bot.edit_message_media,
+                    chat_id=chat_id,
+                    message_id=msg.message_id,
+                    media=InputMediaPhoto(media=thumb, caption=text, parse_mode="HTML"),
+                    reply_markup=kb,
+                )
+            elif not is_photo and thumb:
+                await _tg_call(
+                    app.bot.edit_message_text,
+                    chat_id=chat_id,
+                    message_id=msg.message_id,
+                    text=f"{thumb}\n\n{text}",
+                    parse_mode="HTML",
+                    reply_markup=kb,
+                    disable_web_page_preview=False,
+                )
+            else:
+                await _tg_call(
+                    app.bot.edit_message_reply_markup,
+                    chat_id=chat_id,
+                    message_id=msg.message_id,
+                    reply_markup=kb,
+                )
+        except Exception as e:
+            print(f"[ANNOUNCE] enrich failed in {chat_id}: {e}")
 
 # ЕЖЕЧАСНЫЕ НАПОМИНАНИЯ ПО ЛАЙВУ
 async def _live_reminder_loop(app: Application):
@@ -526,21 +1605,23 @@ async def _live_reminder_loop(app: Application):
     try:
         while True:
             await asyncio.sleep(max(1, LIVE_REMINDER_EVERY_MIN * 60))
-            if not twitch_is_live():
+            if not await asyncio.to_thread(twitch_is_live):
                 print("[LIVE-REM] offline detected -> stop")
                 break
             # удаляем предыдущие напоминания
             for chat_id, mid in list(_live_last_msg_by_chat.items()):
-                try:
-                    await app.bot.delete_message(chat_id=chat_id, message_id=mid)
-                except Exception:
-                    pass
+                _enqueue_delete(chat_id, mid)
             kb = build_watch_kb_for_reminder()
             # ВАЖНО: отправляем ТОЛЬКО в LIVE_REMINDER_CHAT_IDS (канала тут нет)
             for chat_id in LIVE_REMINDER_CHAT_IDS:
                 try:
-                    msg = await app.bot.send_message(
-                        chat_id=chat_id,
+                    info = _chat_info(chat_id)
+                    if info and not info.reachable:
+                        continue
+                    msg = await _tg_call(
+                        app.bot.send_message,
+                        idempotent=False,
+                        chat_id=_resolved_chat_id(chat_id),
                         text="Мы всё ещё на стриме, врывайся! 😏",
                         reply_markup=kb,
                         disable_notification=False,
@@ -569,15 +1650,15 @@ async def _daily_schedule_loop(app: Application):
             if hhmm in DAILY_SCHEDULE_TIMES:
                 key = now.strftime("%Y-%m-%d ") + hhmm
                 if key not in _posted_daily_keys:
-                    _posted_daily_keys.add(key)
-                    await _post_today_schedule_if_any(app)
+                    _posted_daily_keys[key] = True
+                    await _post_today_schedule_if_any(app, key)
             await asyncio.sleep(30)
         except Exception as e:
             print(f"[DAILY] loop error: {e}")
             await asyncio.sleep(5)
 
-async def _post_today_schedule_if_any(app: Application):
-    tasks = _tasks_fetch_all()
+async def _post_today_schedule_if_any(app: Application, post_key: Optional[str] = None):
+    tasks = await asyncio.to_thread(_tasks_fetch_all)
     today = now_local().date()
     todays = [t for t in tasks if _due_to_local_date(t.get("due") or "") == today]
     if not todays:
@@ -593,19 +1674,112 @@ async def _post_today_schedule_if_any(app: Application):
         kb,
         SCHEDULE_IMAGE_URL,
         silent=False,
+        idem_key=f"daily:{post_key}" if post_key else None,
     )
 
+# ЗАКРЕПЛЁННОЕ РАСПИСАНИЕ НА НЕДЕЛЮ
+def _pinned_get(chat_ref: int | str) -> Tuple[Optional[int], Optional[str]]:
+    db = _state_conn()
+    row = db.execute("SELECT message_id, digest FROM pinned_schedule WHERE chat = ?", (str(chat_ref),)).fetchone()
+    return (row[0], row[1]) if row else (None, None)
+
+def _pinned_set(chat_ref: int | str, message_id: int, digest: str):
+    db = _state_conn()
+    db.execute("INSERT OR REPLACE INTO pinned_schedule (chat, message_id, digest) VALUES (?, ?, ?)",
+               (str(chat_ref), message_id, digest))
+    db.commit()
+
+def _pinned_text(tasks: List[dict], today: date) -> str:
+    return "📌 " + _render_week_from(tasks, today) + "\n\nОбновляется автоматически."
+
+async def _update_pinned_schedule(app: Application, chat_ref: int | str, text: str) -> bool:
+    """Правим закреп на месте, если текст изменился; если закрепа нет (или удалён) — шлём новый и закрепляем."""
+    info = _chat_info(chat_ref)
+    if info and not info.reachable:
+        return True
+    digest = hashlib.sha256(text.encode("utf-8")).hexdigest()
+    mid, old_digest = _pinned_get(chat_ref)
+    if mid and old_digest == digest:
+        return True
+    target = _resolved_chat_id(chat_ref)
+    if mid:
+        try:
+            await _tg_call(app.bot.edit_message_text, chat_id=target, message_id=mid,
+                           text=text, parse_mode="HTML")
+            _pinned_set(chat_ref, mid, digest)
+            return True
+        except BadRequest as e:
+            if "not modified" in str(e).lower():
+                _pinned_set(chat_ref, mid, digest)
+                return True
+            print(f"[PIN] edit failed in {chat_ref}: {e} -> repost")
+        except Exception as e:
+            print(f"[PIN] edit error in {chat_ref}: {e}")
+            return False
+    try:
+        msg = await _tg_call(app.bot.send_message, idempotent=False, chat_id=target, text=text,
+                             parse_mode="HTML", disable_notification=True)
+    except Exception as e:
+        print(f"[PIN] send error in {chat_ref}: {e}")
+        return False
+    _pinned_set(chat_ref, msg.message_id, digest)
+    try:
+        await _tg_call(app.bot.pin_chat_message, chat_id=target, message_id=msg.message_id,
+                       disable_notification=True)
+    except Exception as e:
+        print(f"[PIN] pin failed in {chat_ref}: {e}")
+    if mid:
+        _enqueue_delete(target, mid)
+    return True
+
+async def _pinned_schedule_loop(app: Application):
+    """Перерисовываем закреп только при смене расписания (версия кэша задач) или даты (полночь)."""
+    print("[PIN] loop started")
+    last_key = None
+    last_sync = 0.0
+    while True:
+        try:
+            if time.time() - last_sync >= PINNED_SYNC_SECONDS:
+                await _tasks_get_cached(max_age=PINNED_SYNC_SECONDS)
+                last_sync = time.time()
+            today = now_local().date()
+            key = (int(_tasks_cache["ver"]), today)
+            if key != last_key and int(_tasks_cache["ver"]) > 0:
+                text = _pinned_text(_tasks_cache["items"], today)  # type: ignore[arg-type]
+                ok = True
+                for chat_ref in SCHEDULE_REMINDER_CHAT_IDS:
+                    ok = await _update_pinned_schedule(app, chat_ref, text) and ok
+                if ok:
+                    last_key = key
+        except Exception as e:
+            print(f"[PIN] loop error: {e}")
+        await asyncio.sleep(30)
+
+# ==================== ПАМЯТЬ ====================
+async def _memory_report_loop():
+    while True:
+        await asyncio.sleep(max(60, MEMORY_REPORT_EVERY_MIN * 60))
+        try:
+            for m in _bounded_maps:
+                m.purge_expired()
+            for name, st in _memory_stats().items():
+                print(f"[MEM] {name}: size={st['size']}/{st['max_size']} evicted={st['evictions']} "
+                      f"expired={st['expirations']} ~{st['approx_bytes'] // 1024}KB")
+        except Exception as e:
+            print(f"[MEM] report error: {e}")
+
 # ==================== ЯДРО: «будильник» ====================
 async def minute_loop(app: Application):
     print(f"[WAKE] minute loop started at {now_local().isoformat()}")
     while True:
         try:
             if _sec_since(_last_called_ts["tw"]) >= 60:
-                tw = twitch_check_live()
+                tw = await asyncio.to_thread(twitch_check_live)
                 if tw:
-                    yt_live = await yt_fetch_live_with_retries(max_attempts=3, delay_seconds=10)
-                    title = tw.get("title") or (yt_live.get("title") if yt_live else "Стрим")
-                    await _announce_with_sources(app, title, yt_live)
+                    # Постим сразу (Twitch-заголовок + статичная картинка), YouTube догоняем фоном
+                    title = tw.get("title") or "Стрим"
+                    sent = await _announce_with_sources(app, title, None, idem_key=f"announce:{tw['id']}")
+                    _spawn(_enrich_announce_with_youtube(app, sent, title))
                     _start_live_reminders_if_needed(app)
                 _last_called_ts["tw"] = int(time.time())
         except Exception as e:
@@ -686,20 +1860,34 @@ def _month_title(year: int, month: int, idx: int, total: int) -> str:
     ru_months = ["","Январь","Февраль","Март","Апрель","Май","Июнь","Июль","Август","Сентябрь","Октябрь","Ноябрь","Декабрь"]
     return f"📆 {ru_months[month]} {year} — Неделя {idx+1}/{total}"
 
+def _shift_month(year: int, month: int, delta: int) -> Tuple[int, int]:
+    m = year * 12 + (month - 1) + delta
+    return m // 12, m % 12 + 1
+
+def _month_neighbour(year: int, month: int, idx: int, step: int) -> Tuple[int, int, int]:
+    """Соседняя неделя (step = -1/+1) с переходом через границу месяца."""
+    total = len(_month_weeks(year, month))
+    j = idx + step
+    if 0 <= j < total:
+        return year, month, j
+    y2, m2 = _shift_month(year, month, step)
+    return (y2, m2, len(_month_weeks(y2, m2)) - 1) if step < 0 else (y2, m2, 0)
+
 def _month_kb(ym: str, idx: int, total: int) -> InlineKeyboardMarkup:
-    prev_idx = (idx - 1) % total
-    next_idx = (idx + 1) % total
+    year, month = map(int, ym.split("-"))
+    py, pm, pidx = _month_neighbour(year, month, idx, -1)
+    ny, nm, nidx = _month_neighbour(year, month, idx, +1)
     return InlineKeyboardMarkup([
-        [InlineKeyboardButton("◀️", callback_data=f"m|{ym}|{prev_idx}"),
+        [InlineKeyboardButton("◀️", callback_data=f"m|{py:04d}-{pm:02d}|{pidx}"),
          InlineKeyboardButton(f"Неделя {idx+1}/{total}", callback_data=f"m|{ym}|{idx}"),
-         InlineKeyboardButton("▶️", callback_data=f"m|{ym}|{next_idx}")],
+         InlineKeyboardButton("▶️", callback_data=f"m|{ny:04d}-{nm:02d}|{nidx}")],
         [InlineKeyboardButton("← Меню", callback_data="menu|main")]
     ])
 
 # ==================== TTL МЕНЮ ====================
 def _cancel_menu_timer(chat_id: int, message_id: int):
     key = (chat_id, message_id)
-    task = _menu_timers.pop(key, None)
+    task, _ = _menu_timers.pop(key, None) or (None, 0.0)
     if task and not task.done():
         task.cancel()
 
@@ -709,32 +1897,76 @@ def _find_anchor_key_by_message(chat_id: int, message_id: int) -> Optional[Tuple
             return (c, u)
     return None
 
-async def _menu_ttl_worker(chat_id: int, message_id: int):
+async def _menu_ttl_worker(chat_id: int, message_id: int, delay: float = MENU_TTL_SECONDS):
     try:
-        await asyncio.sleep(MENU_TTL_SECONDS)
+        await asyncio.sleep(delay)
         # Стараемся удалить ровно это меню
-        try:
-            await app_global.bot.delete_message(chat_id=chat_id, message_id=message_id)
-        except Exception:
-            pass
+        _enqueue_delete(chat_id, message_id)
         # Чистим якорь, если соответствовал
         ak = _find_anchor_key_by_message(chat_id, message_id)
         if ak:
             _user_menu_anchor.pop(ak, None)
     finally:
-        _menu_timers.pop((chat_id, message_id), None)
+        # снимаем запись, только если она всё ещё наша (при продлении TTL там уже новый таймер)
+        entry = _menu_timers.get((chat_id, message_id))
+        if entry and entry[0] is asyncio.current_task():
+            _menu_timers.pop((chat_id, message_id), None)
 
-def _arm_menu_ttl(chat_id: int, message_id: int):
+def _arm_menu_ttl(chat_id: int, message_id: int, delay: float = MENU_TTL_SECONDS):
     _cancel_menu_timer(chat_id, message_id)
-    task = asyncio.create_task(_menu_ttl_worker(chat_id, message_id))
-    _menu_timers[(chat_id, message_id)] = task
+    task = _create_detached_task(_menu_ttl_worker(chat_id, message_id, delay))
+    _menu_timers[(chat_id, message_id)] = (task, time.time() + delay)
 
 def _extend_menu_ttl(chat_id: int, message_id: int):
     _arm_menu_ttl(chat_id, message_id)
+    # якорь живёт по TTL записи (BoundedMap.get его не продлевает) — перезаписываем вместе с таймером,
+    # иначе меню, которое долго листают, теряет якорь и следующий KB_LABEL оставит его висеть
+    ak = _find_anchor_key_by_message(chat_id, message_id)
+    if ak:
+        _user_menu_anchor[ak] = message_id
+
+def _persist_menu_timers():
+    """При остановке: живые меню (с их настоящим сроком) и якоря записываем в SQLite для нового процесса."""
+    db = _state_conn()
+    rows = [(c, m, expires_at) for (c, m), (task, expires_at) in _menu_timers.items() if task and not task.done()]
+    anchors = [(c, u, mid) for (c, u), mid in _user_menu_anchor.items()]
+    db.executemany("INSERT OR REPLACE INTO menu_ttl (chat_id, message_id, expires_at) VALUES (?, ?, ?)", rows)
+    db.executemany("INSERT OR REPLACE INTO menu_anchor (chat_id, user_id, message_id) VALUES (?, ?, ?)", anchors)
+    db.commit()
+    for _, (task, _) in _menu_timers.items():
+        if task and not task.done():
+            task.cancel()
+    _menu_timers.clear()
+    print(f"[MENU] persisted {len(rows)} menu timers, {len(anchors)} anchors")
+
+def _restore_menu_timers():
+    db = _state_conn()
+    now = time.time()
+    rows = db.execute("SELECT chat_id, message_id, expires_at FROM menu_ttl").fetchall()
+    anchors = db.execute("SELECT chat_id, user_id, message_id FROM menu_anchor").fetchall()
+    db.execute("DELETE FROM menu_ttl")
+    db.execute("DELETE FROM menu_anchor")
+    db.commit()
+    alive = set()
+    restored_anchors = 0
+    for chat_id, message_id, expires_at in rows:
+        delay = expires_at - now
+        if delay <= 0:
+            _enqueue_delete(chat_id, message_id)
+        else:
+            _arm_menu_ttl(chat_id, message_id, delay)
+            alive.add((chat_id, message_id))
+    # якорь нужен, только пока его меню живо: иначе следующее нажатие удалило бы чужое/уже удалённое
+    for chat_id, user_id, message_id in anchors:
+        if (chat_id, message_id) in alive:
+            _user_menu_anchor[(chat_id, user_id)] = message_id
+            restored_anchors += 1
+    if rows or anchors:
+        print(f"[MENU] restored {len(alive)} menu timers, {restored_anchors} anchors")
 
 # ==================== РЕНДЕРЫ ТЕКСТОВ РАСПИСАНИЯ ====================
 async def _ensure_tasks_env(update: Optional[Update]) -> bool:
-    if not (GOOGLE_TASKS_CLIENT_ID and GOOGLE_TASKS_CLIENT_SECRET and GOOGLE_TASKS_REFRESH_TOKEN and GOOGLE_TASKS_LIST_ID):
+    if not _tasks_env_ok():
         if update and update.effective_message:
             await update.effective_message.reply_text(
                 "❗ Не настроен доступ к Google Tasks. "
@@ -746,30 +1978,263 @@ async def _ensure_tasks_env(update: Optional[Update]) -> bool:
     return True
 
 async def _render_today_text() -> str:
-    tasks = _tasks_fetch_all()
+    tasks = await _tasks_get_cached()
     d = now_local().date()
     todays = [t for t in tasks if _due_to_local_date(t.get("due") or "") == d]
     return _format_today_plain(todays, d)
 
 async def _render_week_text() -> str:
-    tasks = _tasks_fetch_all()
-    start = now_local().date()
+    tasks = await _tasks_get_cached()
+    return _render_week_from(tasks, now_local().date())
+
+def _render_week_from(tasks: List[dict], start: date) -> str:
     end = start + timedelta(days=6)
     # фикс формата даты: %m (латинская m), а не кириллическая
     return _format_table_for_range(tasks, start, end, f"🗓 Неделя — {start.strftime('%d.%m')}–{end.strftime('%d.%m')}")
 
-async def _render_month_text(idx: int | None = None) -> Tuple[str, InlineKeyboardMarkup]:
-    tasks = _tasks_fetch_all()
-    today = now_local().date()
-    year, month = today.year, today.month
+def _render_month_week_from(tasks: List[dict], year: int, month: int, idx: int) -> Tuple[str, InlineKeyboardMarkup]:
     weeks = _month_weeks(year, month)
-    i = idx if idx is not None else 0
-    i = max(0, min(i, len(weeks) - 1))
+    i = max(0, min(idx, len(weeks) - 1))
     start, end = weeks[i]
     text = _format_table_for_range(tasks, start, end, _month_title(year, month, i, len(weeks)))
     kb = _month_kb(f"{year:04d}-{month:02d}", i, len(weeks))
     return text, kb
 
+async def _render_month_week(year: int, month: int, idx: int) -> Tuple[str, InlineKeyboardMarkup]:
+    tasks = await _tasks_get_cached()
+    ver = int(_tasks_cache["ver"])
+    key = (year, month, idx)
+    cached = _month_render_cache.get(key)
+    if cached and cached[0] == ver:
+        return cached[1], cached[2]
+    text, kb = _render_month_week_from(tasks, year, month, idx)
+    _month_render_cache[key] = (ver, text, kb)
+    return text, kb
+
+async def _prefetch_month_neighbours(year: int, month: int, idx: int):
+    """Фоном: освежить задачи и пререндерить соседние недели и месяцы для следующего ◀️/▶️."""
+    try:
+        # если кэш скоро протухнет — обновим заранее, чтобы клик не ждал Google
+        await _tasks_get_cached(max_age=TASKS_CACHE_TTL_SECONDS / 2)
+        targets = {
+            _month_neighbour(year, month, idx, -1),
+            _month_neighbour(year, month, idx, +1),
+        }
+        for delta in (-1, 1):
+            y2, m2 = _shift_month(year, month, delta)
+            targets.add((y2, m2, 0))
+        for y2, m2, i2 in targets:
+            await _render_month_week(y2, m2, i2)
+    except Exception as e:
+        print(f"[MONTH] prefetch error: {e}")
+
+def _schedule_month_prefetch(year: int, month: int, idx: int):
+    # частые клики по одной неделе не плодят одинаковые префетчи
+    _spawn_once(("month_prefetch", year, month, idx), _prefetch_month_neighbours(year, month, idx))
+
+async def _render_month_text(idx: int | None = None) -> Tuple[str, InlineKeyboardMarkup]:
+    today = now_local().date()
+    year, month = today.year, today.month
+    i = idx if idx is not None else 0
+    i = max(0, min(i, len(_month_weeks(year, month)) - 1))
+    text, kb = await _render_month_week(year, month, i)
+    _schedule_month_prefetch(year, month, i)
+    return text, kb
+
+# ==================== ИНЛАЙН-РЕЖИМ ====================
+_inline_date_re = re.compile(r"^(\d{1,2})\.(\d{1,2})(?:\.(\d{2,4}))?$")
+_inline_iso_re = re.compile(r"^(\d{4})-(\d{2})-(\d{2})$")
+
+async def _get_schedule_index() -> Dict[str, object]:
+    """
+    Готовые тексты для инлайн-ответов: сегодня, неделя и каждый день на INLINE_INDEX_DAYS вперёд.
+    Google не ждём (см. _tasks_snapshot): индекс пересоберётся при следующем запросе после обновления кэша.
+    """
+    tasks = await _tasks_snapshot()
+    today = now_local().date()
+    key = (int(_tasks_cache["ver"]), today)
+    if _schedule_index["key"] == key:
+        return _schedule_index
+    by_date = _tasks_by_date_map(tasks)
+    end = today + timedelta(days=6)
+    days: Dict[date, str] = {}
+    for d in _daterange_days(today, today + timedelta(days=INLINE_INDEX_DAYS - 1)):
+        days[d] = _format_today_plain(by_date.get(d, []), d, is_today=(d == today))
+    _schedule_index.update({
+        "key": key,
+        "today": days[today],
+        "week": _format_table_for_range(tasks, today, end, f"🗓 Неделя — {today.strftime('%d.%m')}–{end.strftime('%d.%m')}"),
+        "days": days,
+    })
+    return _schedule_index
+
+def _parse_inline_date(q: str, today: date) -> Optional[date]:
+    m = _inline_iso_re.match(q)
+    if m:
+        y, mo, d = int(m.group(1)), int(m.group(2)), int(m.group(3))
+    else:
+        m = _inline_date_re.match(q)
+        if not m:
+            return None
+        d, mo = int(m.group(1)), int(m.group(2))
+        y = int(m.group(3)) if m.group(3) else today.year
+        if y < 100:
+            y += 2000
+    try:
+        return date(y, mo, d)
+    except ValueError:
+        return None
+
+def _inline_article(rid: str, title: str, text: str, parse_mode: Optional[str] = None) -> InlineQueryResultArticle:
+    return InlineQueryResultArticle(
+        id=rid,
+        title=title,
+        description=text.split("\n", 1)[0][:100],
+        input_message_content=InputTextMessageContent(text, parse_mode=parse_mode),
+    )
+
+def _inline_results(q: str, idx: Dict[str, object], today: date) -> List[InlineQueryResultArticle]:
+    """Ответы на инлайн-запрос из готового индекса (_get_schedule_index) — без обращений к Google."""
+    days: Dict[date, str] = idx["days"]  # type: ignore[assignment]
+    results: List[InlineQueryResultArticle] = []
+    if q in ("", "today", "сегодня"):
+        results.append(_inline_article("today", "📅 Стримы сегодня", idx["today"]))  # type: ignore[arg-type]
+    if q in ("", "week", "неделя"):
+        results.append(_inline_article("week", "🗓 Стримы на неделю", idx["week"], parse_mode="HTML"))  # type: ignore[arg-type]
+    if not results:
+        d = _parse_inline_date(q, today)
+        if d is not None:
+            text = days.get(d)
+            if text is None:
+                # вне предрассчитанного окна — собираем из того же кэша задач
+                by_date = _tasks_by_date_map(_tasks_cache["items"])  # type: ignore[arg-type]
+                text = _format_today_plain(by_date.get(d, []), d, is_today=(d == today))
+            results.append(_inline_article(f"d{d.isoformat()}", f"📅 Стримы {d.strftime('%d.%m.%Y')}", text))
+    return results
+
+async def _answer_inline(iq, results: List[InlineQueryResultArticle]):
+    try:
+        await iq.answer(results, cache_time=INLINE_CACHE_SECONDS, is_personal=False)
+    except Exception as e:
+        print(f"[INLINE] answer failed: {e}")
+
+async def on_inline_query(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    iq = update.inline_query
+    if not iq:
+        return
+    q = (iq.query or "").strip().lower()
+    idx = await _get_schedule_index()
+    await _answer_inline(iq, _inline_results(q, idx, now_local().date()))
+
+# ==================== ФИДЫ РАСПИСАНИЯ (ICS/JSON) ====================
+def _schedule_model(tasks: List[dict]) -> List[dict]:
+    """Разобранное расписание: [{id, date, time, title, updated}] по дате/времени."""
+    events = []
+    for t in tasks:
+        d = _due_to_local_date(t.get("due") or "")
+        if not d:
+            continue
+        hhmm, title = _extract_time_from_title(t.get("title") or "")
+        events.append({
+            "id": t.get("id") or hashlib.sha1(f"{d}{t.get('title')}".encode()).hexdigest()[:16],
+            "date": d,
+            "time": hhmm,
+            "title": title,
+            "updated": t.get("updated") or "",
+        })
+    events.sort(key=lambda e: (e["date"], e["time"] or "99:99", e["id"]))
+    return events
+
+def _ics_escape(s: str) -> str:
+    return s.replace("\\", "\\\\").replace(";", "\\;").replace(",", "\\,").replace("\n", "\\n")
+
+def _ics_fold(line: str) -> str:
+    # RFC 5545: строки длиннее 75 октетов переносим с пробелом в начале продолжения
+    raw = line.encode("utf-8")
+    if len(raw) <= 75:
+        return line
+    parts, cur = [], b""
+    for ch in line:
+        b = ch.encode("utf-8")
+        if len(cur) + len(b) > (75 if not parts else 74):
+            parts.append(cur.decode("utf-8"))
+            cur = b""
+        cur += b
+    parts.append(cur.decode("utf-8"))
+    return "\r\n ".join(parts)
+
+def _ics_utc(dt_local: datetime) -> str:
+    return (dt_local - timedelta(hours=TZ_OFFSET_HOURS)).strftime("%Y%m%dT%H%M%SZ")
+
+def _render_ics(events: List[dict]) -> bytes:
+    lines = [
+        "BEGIN:VCALENDAR",
+        "VERSION:2.0",
+        f"PRODID:-//{BOT_NAME}//schedule//RU",
+        "CALSCALE:GREGORIAN",
+        "X-WR-CALNAME:DEKTRIAN — стримы",
+    ]
+    for e in events:
+        d: date = e["date"]
+        # DTSTAMP обязателен; берём время изменения задачи, чтобы тело (и ETag) было стабильным
+        stamp = e["updated"][:19].replace("-", "").replace(":", "") + "Z" if e["updated"] else d.strftime("%Y%m%dT000000Z")
+        lines += ["BEGIN:VEVENT", f"UID:{e['id']}@{BOT_NAME}", f"DTSTAMP:{stamp}"]
+        if e["time"]:
+            hh, mm = map(int, e["time"].split(":"))
+            start = datetime(d.year, d.month, d.day) + timedelta(hours=hh, minutes=mm)
+            lines += [f"DTSTART:{_ics_utc(start)}",
+                      f"DTEND:{_ics_utc(start + timedelta(minutes=FEED_EVENT_DURATION_MIN))}"]
+        else:
+            lines += [f"DTSTART;VALUE=DATE:{d.strftime('%Y%m%d')}",
+                      f"DTEND;VALUE=DATE:{(d + timedelta(days=1)).strftime('%Y%m%d')}"]
+        lines += [f"SUMMARY:{_ics_escape(e['title'])}",
+                  f"URL:https://www.twitch.tv/{TWITCH_USERNAME}",
+                  "END:VEVENT"]
+    lines.append("END:VCALENDAR")
+    return ("\r\n".join(_ics_fold(x) for x in lines) + "\r\n").encode("utf-8")
+
+def _render_schedule_json(events: List[dict]) -> bytes:
+    return json.dumps({
+        "timezone_offset_hours": TZ_OFFSET_HOURS,
+        "events": [{"id": e["id"], "date": e["date"].isoformat(), "time": e["time"], "title": e["title"]}
+                   for e in events],
+    }, ensure_ascii=False, separators=(",", ":")).encode("utf-8")
+
+def _strong_etag(body: bytes) -> str:
+    return '"' + hashlib.sha256(body).hexdigest()[:32] + '"'
+
+async def _get_feeds() -> Dict[str, object]:
+    """Фиды из кэша задач; запрос фида не ждёт Google (см. _tasks_snapshot)."""
+    await _tasks_snapshot()
+    ver = int(_tasks_cache["ver"])
+    if _feed_cache["ver"] != ver:
+        events = _schedule_model(_tasks_cache["items"])  # type: ignore[arg-type]
+        ics, js = _render_ics(events), _render_schedule_json(events)
+        _feed_cache.update({"ver": ver, "ics": ics, "json": js,
+                            "etag_ics": _strong_etag(ics), "etag_json": _strong_etag(js)})
+    return _feed_cache
+
+def _etag_matches(header: Optional[str], etag: str) -> bool:
+    if not header:
+        return False
+    if header.strip() == "*":
+        return True
+    return etag in [x.strip() for x in header.split(",")]
+
+def _feed_response(request: web.Request, body: bytes, etag: str, content_type: str) -> web.Response:
+    headers = {"ETag": etag, "Cache-Control": f"public, max-age={FEED_MAX_AGE_SECONDS}"}
+    if _etag_matches(request.headers.get("If-None-Match"), etag):
+        return web.Response(status=304, headers=headers)
+    return web.Response(body=body, headers=headers, content_type=content_type, charset="utf-8")
+
+async def http_schedule_ics(request: web.Request) -> web.Response:
+    feeds = await _get_feeds()
+    return _feed_response(request, feeds["ics"], feeds["etag_ics"], "text/calendar")  # type: ignore[arg-type]
+
+async def http_schedule_json(request: web.Request) -> web.Response:
+    feeds = await _get_feeds()
+    return _feed_response(request, feeds["json"], feeds["etag_json"], "application/json")  # type: ignore[arg-type]
+
 # ==================== ПОКАЗ МЕНЮ (персональный, с удалением старого) ====================
 async def _show_main_menu_for_user(update: Update, context: ContextTypes.DEFAULT_TYPE):
     chat_id = update.effective_chat.id
@@ -777,20 +2242,14 @@ async def _show_main_menu_for_user(update: Update, context: ContextTypes.DEFAULT
     anchor_key = (chat_id, user_id)
 
     # 1) удаляем сообщение-триггер пользователя (из клавиатуры)
-    try:
-        if update.effective_message:
-            await context.bot.delete_message(chat_id=chat_id, message_id=update.effective_message.message_id)
-    except Exception:
-        pass
+    if update.effective_message:
+        _enqueue_delete(chat_id, update.effective_message.message_id)
 
     # 2) если у этого пользователя уже было меню — удалим его и таймер
     old_msg_id = _user_menu_anchor.get(anchor_key)
     if old_msg_id:
         _cancel_menu_timer(chat_id, old_msg_id)
-        try:
-            await context.bot.delete_message(chat_id=chat_id, message_id=old_msg_id)
-        except Exception:
-            pass
+        _enqueue_delete(chat_id, old_msg_id)
         _user_menu_anchor.pop(anchor_key, None)
 
     # 3) создаём новое личное меню (без звука)
@@ -853,7 +2312,11 @@ async def on_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
         return
     q = update.callback_query
     data = q.data or ""
-    await q.answer()
+    try:
+        await q.answer()
+    except BadRequest as e:
+        # после рестарта из бэклога приходят «старые» колбэки — ответить уже нельзя, но клик обработаем
+        print(f"[CB] answer failed: {e}")
 
     chat_id = q.message.chat.id
     msg_id = q.message.message_id
@@ -915,14 +2378,14 @@ async def on_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
             idx = int(idx_str)
         except Exception:
             return
-        tasks = _tasks_fetch_all()
+        if not (1 <= month <= 12):
+            return
         weeks = _month_weeks(year, month)
         if not weeks:
             return
         idx = max(0, min(idx, len(weeks)-1))
-        start, end = weeks[idx]
-        text = _format_table_for_range(tasks, start, end, _month_title(year, month, idx, len(weeks)))
-        kb = _month_kb(ym, idx, len(weeks))
+        text, kb = await _render_month_week(year, month, idx)
+        _schedule_month_prefetch(year, month, idx)
         try:
             await context.bot.edit_message_text(chat_id=chat_id, message_id=msg_id,
                                                 text=text, parse_mode="HTML", reply_markup=kb)
@@ -954,6 +2417,220 @@ async def on_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
             print(f"[CB] br terms err: {e}")
         return
 
+# ==================== АНТИСПАМ (RATE LIMIT) ====================
+class _TokenBucket:
+    __slots__ = ("tokens", "updated")
+
+    def __init__(self, burst: float):
+        self.tokens = burst
+        self.updated = time.monotonic()
+
+    def refill(self, burst: float, per_sec: float, now: float):
+        self.tokens = min(burst, self.tokens + (now - self.updated) * per_sec)
+        self.updated = now
+
+_rate_buckets = BoundedMap("rate_buckets", max_size=20000, ttl=3600)
+_rate_stats: Dict[str, int] = {"allowed": 0, "limited_user": 0, "limited_chat": 0}
+
+_LIMITED_COMMANDS = ("/today", "/week", "/month", "/menu", "/test1")
+
+# дешёвая навигация по уже открытому меню: листание месяца и «назад» — их не лимитируем,
+# иначе пользователь упирается в лимит посреди листания и кнопка «молчит»
+_UNLIMITED_CALLBACK_PREFIXES = ("m|", "menu|main")
+
+def _is_costly_update(update: Update) -> bool:
+    """Лимитируем только то, что ходит в Bot API/Google: меню, расписание, колбэки, инлайн."""
+    if update.callback_query:
+        return not (update.callback_query.data or "").startswith(_UNLIMITED_CALLBACK_PREFIXES)
+    if update.inline_query:
+        return True
+    msg = update.effective_message
+    if not msg or not msg.text:
+        return False
+    text = msg.text.strip()
+    if text.lower() == KB_LABEL_LOWER:
+        return True
+    cmd = text.split()[0].split("@")[0].lower()
+    return cmd in _LIMITED_COMMANDS
+
+def _rate_allow(user_id: Optional[int], chat_id: Optional[int]) -> Optional[str]:
+    """None — можно; иначе какой лимит сработал ("user"/"chat"). Токены списываются только при успехе."""
+    now = time.monotonic()
+    checks = []
+    if user_id is not None:
+        checks.append(("user", ("u", user_id), RATE_USER_BURST, RATE_USER_PER_SEC))
+    if chat_id is not None:
+        checks.append(("chat", ("c", chat_id), RATE_CHAT_BURST, RATE_CHAT_PER_SEC))
+    buckets = []
+    for kind, key, burst, per_sec in checks:
+        b = _rate_buckets.get(key)
+        if b is None:
+            b = _TokenBucket(burst)
+            _rate_buckets[key] = b
+        b.refill(burst, per_sec, now)
+        if b.tokens < 1:
+            return kind
+        buckets.append(b)
+    for b in buckets:
+        b.tokens -= 1
+    return None
+
+async def _rate_limit_drop(update: object) -> bool:
+    """
+    Проверка до очереди по ключу и до слота (см. OrderedUpdateProcessor.process_update):
+    сверх лимита апдейт тихо гасим, и ни блокировок, ни параллельности он не занимает. True — погашен.
+    """
+    if not isinstance(update, Update) or not _is_costly_update(update):
+        return False
+    user = update.effective_user
+    chat = update.effective_chat
+    # в личке чат = пользователь, отдельный чатовый лимит не нужен
+    chat_id = chat.id if chat and chat.type != "private" else None
+    limited = _rate_allow(user.id if user else None, chat_id)
+    if limited is None:
+        _rate_stats["allowed"] += 1
+        return False
+    _rate_stats[f"limited_{limited}"] += 1
+    if update.callback_query:
+        # крутилку на кнопке надо погасить в любом случае
+        try:
+            await update.callback_query.answer()
+        except Exception:
+            pass
+    elif update.inline_query:
+        # без ответа клиент покажет пустой список — отвечаем из уже собранного индекса, в Google не ходим
+        key = _schedule_index["key"]
+        today = now_local().date()
+        if key is not None and key[1] == today:  # type: ignore[index]
+            q = (update.inline_query.query or "").strip().lower()
+            await _answer_inline(update.inline_query, _inline_results(q, _schedule_index, today))
+    elif update.effective_message and chat:
+        # нажатие кнопки/команда просто исчезает из чата (пачкой, как и обычные триггеры)
+        _enqueue_delete(chat.id, update.effective_message.message_id)
+    return True
+
+# ==================== ПАРАЛЛЕЛЬНАЯ ОБРАБОТКА АПДЕЙТОВ ====================
+def _update_order_keys(update: object) -> List[Tuple[str, int, int]]:
+    """
+    Ключи упорядочивания апдейта: апдейты с общим ключом выполняются строго по очереди.
+    ("u", chat_id, user_id) — один пользователь в одном чате (якорь меню),
+    ("m", chat_id, message_id) — одно и то же сообщение-меню (клики по кнопкам).
+    """
+    if not isinstance(update, Update):
+        return []
+    keys: List[Tuple[str, int, int]] = []
+    chat = update.effective_chat
+    user = update.effective_user
+    if chat and user:
+        keys.append(("u", chat.id, user.id))
+    q = update.callback_query
+    if q and q.message:
+        keys.append(("m", q.message.chat.id, q.message.message_id))
+    return keys
+
+class OrderedUpdateProcessor(BaseUpdateProcessor):
+    """
+    Обрабатывает до max_concurrent_updates апдейтов параллельно, но апдейты
+    с общим ключом (см. _update_order_keys) — в порядке поступления.
+    Апдейты сверх лимита антиспама (_rate_limit_drop) гасятся до очереди и до слота.
+    """
+
+    def __init__(self, max_concurrent_updates: int):
+        # Семафор базового класса берётся до do_process_update — апдейты, ждущие своей очереди,
+        # занимали бы слоты. Поэтому ему даём заведомо большой лимит, а свой берём после блокировок.
+        super().__init__(_UNBOUNDED_CONCURRENT_UPDATES)
+        self._slots = asyncio.Semaphore(max_concurrent_updates)
+        # ключ -> [lock, число держателей/ожидающих]
+        self._locks: Dict[Tuple[str, int, int], list] = {}
+        # задачи апдейтов в работе (для отмены по дедлайну остановки) и флаг «новые не начинать»
+        self._inflight: set[asyncio.Task] = set()
+        self._closed = False
+
+    def _acquire_ref(self, key: Tuple[str, int, int]) -> asyncio.Lock:
+        entry = self._locks.get(key)
+        if entry is None:
+            entry = [asyncio.Lock(), 0]
+            self._locks[key] = entry
+        entry[1] += 1
+        return entry[0]
+
+    def _release_ref(self, key: Tuple[str, int, int]):
+        entry = self._locks.get(key)
+        if entry is None:
+            return
+        entry[1] -= 1
+        if entry[1] <= 0:
+            self._locks.pop(key, None)
+
+    async def do_process_update(self, update: object, coroutine) -> None:
+        if self._closed:
+            # остановка после дедлайна: апдейт не начинаем (в polling-режиме он остаётся в журнале)
+            coroutine.close()
+            return
+        task = asyncio.current_task()
+        self._inflight.add(task)
+        cancelled = False
+        try:
+            # Антиспам — раньше всего: лишние клики не встают в очередь пользователя и не ждут слот
+            if await _rate_limit_drop(update):
+                coroutine.close()
+                return
+            await self._process_in_order(update, coroutine)
+        except asyncio.CancelledError:
+            cancelled = True
+            raise
+        finally:
+            self._inflight.discard(task)
+            # отменённый апдейт не отмечаем: в polling-режиме он остаётся в журнале и повторится
+            if not cancelled:
+                _poll_update_finished(update)
+
+    def cancel_inflight(self) -> int:
+        """Дедлайн остановки вышел: новые апдейты не начинаем, идущие отменяем. Возвращает число отменённых."""
+        self._closed = True
+        tasks = [t for t in self._inflight if not t.done()]
+        for t in tasks:
+            t.cancel()
+        return len(tasks)
+
+    async def _process_in_order(self, update: object, coroutine) -> None:
+        # Сначала очередь по ключу, потом слот: апдейт, ждущий своей очереди, слот не занимает,
+        # поэтому серия кликов одного пользователя не задерживает остальных.
+        # Сортировка ключей — единый порядок захвата, без взаимных блокировок.
+        keys = sorted(set(_update_order_keys(update)))
+        locks = [self._acquire_ref(k) for k in keys]
+        acquired: List[asyncio.Lock] = []
+        trace = _Trace(_update_label(update))
+        token = _current_trace.set(trace)
+        try:
+            with _span("order.wait"):
+                for lock in locks:
+                    await lock.acquire()
+                    acquired.append(lock)
+            with _span("slot.wait"):
+                await self._slots.acquire()
+            try:
+                with _span("handler"):
+                    await coroutine
+            finally:
+                self._slots.release()
+        finally:
+            # отменили, пока ждали очереди/слота — корутина хендлера так и не запускалась
+            coroutine.close()
+            for lock in reversed(acquired):
+                lock.release()
+            for k in keys:
+                self._release_ref(k)
+            trace.duration = time.perf_counter() - trace.started_perf
+            _recent_traces.append(trace)
+            _current_trace.reset(token)
+
+    async def initialize(self) -> None:
+        pass
+
+    async def shutdown(self) -> None:
+        self._locks.clear()
+
 # ==================== ERROR-HANDLER ====================
 async def on_error(update: object, context: ContextTypes.DEFAULT_TYPE):
     err = context.error
@@ -966,7 +2643,7 @@ async def on_error(update: object, context: ContextTypes.DEFAULT_TYPE):
     print(f"[HOOK] unhandled error: {err}")
 
 # ==================== STARTUP ====================
-app_global: Application  # для TTL-воркера (delete_message)
+app_global: Application  # глобальная ссылка на приложение для фоновых воркеров
 
 async def _on_start(app: Application):
     global app_global
@@ -980,11 +2657,17 @@ async def _on_start(app: Application):
         BotCommand("menu",  "Открыть меню"),
     ])
 
-    # 2) Показать клавиатуру тихим сервисным сообщением (чтобы закрепилась у всех)
+    # 2) Реестр чатов: теги -> числовые id, права на фото
+    await _chat_registry_refresh(app)
+
+    # 3) Показать клавиатуру тихим сервисным сообщением (чтобы закрепилась у всех)
     for chat_id in _ids_or_default([]):
+        info = _chat_info(chat_id)
+        if info and (not info.reachable or info.type == "channel"):
+            continue
         try:
             await app.bot.send_message(
-                chat_id=chat_id,
+                chat_id=_resolved_chat_id(chat_id),
                 text="Клавиатура активна. Нажми «Расписание стримов и прочее» ⤵️",
                 reply_markup=main_reply_kb(),
                 disable_notification=MUTE_SERVICE_MESSAGES,
@@ -992,23 +2675,354 @@ async def _on_start(app: Application):
         except Exception as e:
             print(f"[STARTED] cannot show keyboard in {chat_id}: {e}")
 
-    # 3) Фоновые задачи
-    asyncio.create_task(minute_loop(app))
-    asyncio.create_task(self_ping())
-    asyncio.create_task(_daily_schedule_loop(app))
+    # 4) Фоновые задачи (меню, пережившие рестарт, снова ставим на TTL)
+    _restore_menu_timers()
+    _spawn(_chat_registry_loop(app))
+    _spawn(minute_loop(app))
+    _spawn(self_ping())
+    _spawn(_daily_schedule_loop(app))
+    _spawn(_delete_flush_loop(app))
+    _outbox_start(app)
+    _spawn(_memory_report_loop())
+    if _tasks_env_ok():
+        # прогрев кэша задач: первый инлайн-запрос/фид не будет ждать Google
+        _spawn_once("tasks_refresh", _tasks_get_cached())
+    if PINNED_SCHEDULE_ENABLED and _tasks_env_ok():
+        _spawn(_pinned_schedule_loop(app))
     print(f"[STARTED] {BOT_NAME} at {now_local().isoformat()}")
 
+# ==================== HTTP-СЕРВЕР (вебхук + фиды) ====================
+async def http_webhook(request: web.Request) -> web.Response:
+    application: Application = request.app["tg_app"]
+    if request.headers.get("X-Telegram-Bot-Api-Secret-Token") != WEBHOOK_SECRET:
+        return web.Response(status=403)
+    if not _accepting_updates:
+        # идёт остановка: Telegram повторит доставку, апдейт достанется новому инстансу
+        return web.Response(status=503)
+    try:
+        data = _json_loads(await request.read())
+        update = Update.de_json(data, application.bot)
+    except Exception as e:
+        print(f"[WEBHOOK] bad update: {e}")
+        return web.Response(status=400)
+    await application.update_queue.put(update)
+    return web.Response(text="ok")
+
+def _admin_authorized(request: web.Request) -> bool:
+    if not ADMIN_TOKEN:
+        return False
+    given = request.headers.get("Authorization", "").removeprefix("Bearer ").strip()
+    return hmac.compare_digest(given.encode(), ADMIN_TOKEN.encode())
+
+async def http_admin_traces(request: web.Request) -> web.Response:
+    if not _admin_authorized(request):
+        return web.Response(status=404)
+    return web.json_response({"slowest": _slowest_traces(), "recent": len(_recent_traces)})
+
+async def http_admin_stats(request: web.Request) -> web.Response:
+    if not _admin_authorized(request):
+        return web.Response(status=404)
+    return web.json_response({
+        "rate_limit": _rate_stats,
+        "deletes": _delete_stats,
+        "breakers": {n: b.state for n, b in _breakers.items()},
+        "polling": ({"in_flight": len(_poll_tracker.inflight), "watermark": _poll_tracker.watermark,
+                     "fetched": _poll_tracker.fetched} if _poll_tracker else None),
+        "memory": _memory_stats(),
+    })
+
+async def http_admin_profile(request: web.Request) -> web.Response:
+    """GET /admin/profile?seconds=N — включает сэмплирующий профилировщик на N сек, отдаёт collapsed stacks."""
+    if not _admin_authorized(request):
+        return web.Response(status=404)
+    try:
+        seconds = min(PROFILE_MAX_SECONDS, max(0.1, float(request.query.get("seconds", "10"))))
+    except ValueError:
+        return web.Response(status=400, text="bad seconds")
+    if not _profile_lock.acquire(blocking=False):
+        return web.Response(status=409, text="profile already running")
+    try:
+        counts = await asyncio.to_thread(_sample_stacks, seconds)
+    finally:
+        _profile_lock.release()
+    body = "\n".join(f"{stack} {n}" for stack, n in sorted(counts.items(), key=lambda kv: -kv[1]))
+    return web.Response(text=body + "\n", content_type="text/plain")
+
+async def http_wake(request: web.Request) -> web.Response:
+    return web.Response(text="ok")
+
+def _build_http_app(application: Application, with_webhook: bool = True) -> web.Application:
+    http_app = web.Application()
+    http_app["tg_app"] = application
+    if with_webhook:
+        http_app.router.add_post(WEBHOOK_PATH, http_webhook)
+    http_app.router.add_get("/_wake", http_wake)
+    http_app.router.add_get("/schedule.ics", http_schedule_ics)
+    http_app.router.add_get("/schedule.json", http_schedule_json)
+    http_app.router.add_get("/admin/traces", http_admin_traces)
+    http_app.router.add_get("/admin/profile", http_admin_profile)
+    http_app.router.add_get("/admin/stats", http_admin_stats)
+    return http_app
+
+# ==================== LONG POLLING ====================
+# Telegram считает апдейт подтверждённым, как только getUpdates вызван с большим offset, поэтому,
+# чтобы тянуть следующие пачки, не дожидаясь медленных хендлеров, полученные, но ещё не обработанные
+# апдейты держим в журнале poll_inflight (SQLite): после падения они обрабатываются заново.
+class _PollTracker:
+    """Апдейты из getUpdates в обработке; watermark — offset, ниже которого обработано всё подряд."""
+    __slots__ = ("inflight", "fetched", "changed")
+
+    def __init__(self, fetched: Optional[int]):
+        self.inflight: set[int] = set()
+        self.fetched = fetched          # offset для следующего getUpdates
+        self.changed = asyncio.Event()
+
+    @property
+    def watermark(self) -> Optional[int]:
+        return min(self.inflight) if self.inflight else self.fetched
+
+_poll_tracker: Optional[_PollTracker] = None
+
+def _poll_offset_get() -> Optional[int]:
+    row = _state_conn().execute("SELECT value FROM poll_state WHERE key = 'offset'").fetchone()
+    return row[0] if row else None
+
+def _poll_journal_add(updates: List[Update], offset: int):
+    """Пачку в журнал и новый offset — одной транзакцией, до того как Telegram получит подтверждение."""
+    db = _state_conn()
+    db.executemany("INSERT OR IGNORE INTO poll_inflight (update_id, payload) VALUES (?, ?)",
+                   [(u.update_id, json.dumps(u.to_dict(), ensure_ascii=False)) for u in updates])
+    db.execute("INSERT OR REPLACE INTO poll_state (key, value) VALUES ('offset', ?)", (offset,))
+    db.commit()
+
+def _poll_journal_load(bot) -> List[Update]:
+    rows = _state_conn().execute("SELECT payload FROM poll_inflight ORDER BY update_id").fetchall()
+    return [Update.de_json(_json_loads(raw), bot) for (raw,) in rows]
+
+def _poll_update_finished(update: object):
+    """Вызывается OrderedUpdateProcessor по завершении любого апдейта (в т.ч. погашенного антиспамом)."""
+    tr = _poll_tracker
+    if tr is None or not isinstance(update, Update) or update.update_id not in tr.inflight:
+        return
+    tr.inflight.discard(update.update_id)
+    try:
+        db = _state_conn()
+        db.execute("DELETE FROM poll_inflight WHERE update_id = ?", (update.update_id,))
+        db.commit()
+    except Exception as e:
+        print(f"[POLL] journal delete error: {e}")
+    tr.changed.set()
+
+async def _poll_dispatch(application: Application, updates: List[Update]):
+    for upd in updates:
+        _poll_tracker.inflight.add(upd.update_id)
+        await application.update_queue.put(upd)
+
+async def _polling_loop(application: Application, stop: asyncio.Event):
+    """
+    getUpdates пачками по POLL_BATCH_LIMIT; апдейты уходят в update_queue и обрабатываются
+    параллельно (OrderedUpdateProcessor), а следующая пачка запрашивается сразу, не дожидаясь
+    обработки предыдущей (не больше POLL_MAX_INFLIGHT в работе). Незавершённые — в журнале SQLite.
+    """
+    global _poll_tracker
+    _poll_tracker = _PollTracker(_poll_offset_get())
+    replay = _poll_journal_load(application.bot)
+    print(f"[POLL] started; offset={_poll_tracker.fetched} replay={len(replay)}")
+    await _poll_dispatch(application, replay)
+    stopper = asyncio.create_task(stop.wait())
+    try:
+        await _polling_batches(application, stop, stopper)
+    finally:
+        stopper.cancel()
+    print(f"[POLL] stopped; watermark={_poll_tracker.watermark} in flight={len(_poll_tracker.inflight)}")
+
+async def _polling_batches(application: Application, stop: asyncio.Event, stopper: asyncio.Task):
+    tr = _poll_tracker
+    handled = 0
+    window_start = time.monotonic()
+    fail = 0
+    while not stop.is_set():
+        if len(tr.inflight) >= POLL_MAX_INFLIGHT:
+            # обработка не успевает — ждём, пока что-нибудь завершится, прежде чем брать ещё
+            tr.changed.clear()
+            waiter = asyncio.create_task(tr.changed.wait())
+            try:
+                await asyncio.wait({waiter, stopper}, return_when=asyncio.FIRST_COMPLETED)
+            finally:
+                waiter.cancel()
+            continue
+        fetch = asyncio.create_task(application.bot.get_updates(
+            offset=tr.fetched,
+            limit=POLL_BATCH_LIMIT,
+            timeout=POLL_TIMEOUT_SECONDS,
+            allowed_updates=Update.ALL_TYPES,
+            read_timeout=POLL_TIMEOUT_SECONDS + 10,
+        ))
+        await asyncio.wait({fetch, stopper}, return_when=asyncio.FIRST_COMPLETED)
+        if not fetch.done():
+            # остановка во время long poll: эта пачка не подтверждена, Telegram отдаст её снова
+            fetch.cancel()
+            break
+        try:
+            updates = fetch.result()
+            fail = 0
+        except asyncio.CancelledError:
+            raise
+        except RetryAfter as e:
+            await asyncio.sleep(float(e.retry_after))
+            continue
+        except Conflict as e:
+            print(f"[POLL] conflict (другой инстанс или вебхук?): {e}")
+            await asyncio.sleep(5)
+            continue
+        except Exception as e:
+            fail += 1
+            print(f"[POLL] getUpdates error: {e}")
+            await asyncio.sleep(_backoff_delay(min(fail, 6)))
+            continue
+
+        # апдейты, уже взятые в работу (повтор неподтверждённой пачки после рестарта), второй раз не берём
+        updates = [u for u in updates if u.update_id not in tr.inflight]
+        if updates:
+            tr.fetched = updates[-1].update_id + 1
+            _poll_journal_add(updates, tr.fetched)
+            await _poll_dispatch(application, updates)
+            handled += len(updates)
+
+        elapsed = time.monotonic() - window_start
+        if elapsed >= POLL_REPORT_EVERY_SECONDS:
+            print(f"[POLL] {handled} updates in {elapsed:.0f}s ({handled / elapsed:.2f}/s); "
+                  f"in flight={len(tr.inflight)} watermark={tr.watermark}")
+            handled = 0
+            window_start = time.monotonic()
+
+# ==================== ЗАПУСК: webhook или polling ====================
+async def _run_bot(application: Application, mode: str):
+    """
+    Общий жизненный цикл: aiohttp-сервер (фиды, /_wake, админка; вебхук — только в режиме webhook)
+    и источник апдейтов — setWebhook либо собственный long polling.
+    """
+    stop = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        try:
+            loop.add_signal_handler(sig, stop.set)
+        except NotImplementedError:
+            pass
+
+    runner = web.AppRunner(_build_http_app(application, with_webhook=(mode == "webhook")))
+    poller: Optional[asyncio.Task] = None
+    await application.initialize()
+    try:
+        await application.start()
+        await _on_start(application)
+        await runner.setup()
+        await web.TCPSite(runner, "0.0.0.0", PORT).start()
+        if mode == "webhook":
+            webhook_url = f"{PUBLIC_URL}{WEBHOOK_PATH}"
+            # бэклог, накопленный за время рестарта, НЕ сбрасываем: Telegram дошлёт его
+            # не более чем в WEBHOOK_MAX_CONNECTIONS потоков, дальше ограничивает OrderedUpdateProcessor
+            await application.bot.set_webhook(
+                url=webhook_url,
+                secret_token=WEBHOOK_SECRET,
+                drop_pending_updates=False,
+                max_connections=WEBHOOK_MAX_CONNECTIONS,
+                allowed_updates=None,
+            )
+            print(f"[WEBHOOK] listen 0.0.0.0:{PORT}  path={WEBHOOK_PATH}  url={webhook_url}")
+        else:
+            # getUpdates не работает при активном вебхуке; очередь апдейтов не сбрасываем
+            await application.bot.delete_webhook(drop_pending_updates=False)
+            poller = asyncio.create_task(_polling_loop(application, stop))
+            print(f"[POLL] long polling; http on 0.0.0.0:{PORT}")
+        await stop.wait()
+    finally:
+        await _graceful_shutdown(application, runner, poller)
+
+async def _wait_with_deadline(aw, deadline: float) -> bool:
+    """True — успели до дедлайна (time.monotonic())."""
+    task = asyncio.ensure_future(aw)
+    done, _ = await asyncio.wait({task}, timeout=max(0.0, deadline - time.monotonic()))
+    if not done:
+        task.cancel()
+        return False
+    return True
+
+async def _graceful_shutdown(application: Application, runner: web.AppRunner, poller: Optional[asyncio.Task]):
+    """
+    SIGTERM: 1) перестаём принимать апдейты; 2) дорабатываем уже принятые до SHUTDOWN_DRAIN_SECONDS,
+    не успевшие — отменяем; 3) останавливаем PTB (хендлеров больше нет); 4) гасим фоновые циклы;
+    5) сохраняем состояние (TTL меню, очередь удалений); 6) закрываемся.
+    """
+    global _accepting_updates
+    print("[SHUTDOWN] stopping: no new updates")
+    _accepting_updates = False
+    deadline = time.monotonic() + SHUTDOWN_DRAIN_SECONDS
+
+    if poller and not await _wait_with_deadline(poller, deadline):
+        print("[SHUTDOWN] poller did not stop in time")
+    if application.running:
+        if await _wait_with_deadline(application.update_queue.join(), deadline):
+            print("[SHUTDOWN] in-flight updates drained")
+        else:
+            proc = application.update_processor
+            n = proc.cancel_inflight() if isinstance(proc, OrderedUpdateProcessor) else 0
+            print(f"[SHUTDOWN] drain deadline hit; cancelled {n} handlers"
+                  + (" (they stay in the polling journal)" if poller else ""))
+        # Application.stop() ждёт update_queue.join() и свои задачи без таймаута — страхуемся
+        if not await _wait_with_deadline(application.stop(), time.monotonic() + 5):
+            print("[SHUTDOWN] application.stop() timed out")
+
+    tasks = list(_background_tasks) + list(_outbox_workers)
+    if _live_reminder_task:
+        tasks.append(_live_reminder_task)
+    for t in tasks:
+        t.cancel()
+    await asyncio.gather(*tasks, return_exceptions=True)
+    _background_tasks.clear()
+    _outbox_workers.clear()
+
+    try:
+        _persist_menu_timers()
+    except Exception as e:
+        print(f"[SHUTDOWN] persist menu timers error: {e}")
+    try:
+        await _wait_with_deadline(_flush_delete_queue(application), time.monotonic() + 5)
+    except Exception as e:
+        print(f"[SHUTDOWN] flush deletes error: {e}")
+
+    await runner.cleanup()
+    await application.shutdown()
+    _state_close()
+    print("[SHUTDOWN] done")
+
 # ==================== APP ====================
+def _install_fast_runtime():
+    """FAST_RUNTIME=1: uvloop-политика цикла (до создания Application) + orjson для JSON; чего нет — молча пропускаем."""
+    if not FAST_RUNTIME:
+        return
+    if uvloop is not None:
+        asyncio.set_event_loop_policy(uvloop.EventLoopPolicy())
+    print(f"[RUNTIME] fast profile: uvloop={'on' if uvloop else 'absent'} "
+          f"orjson={'on' if orjson else 'absent'}")
+
 def main():
     if not TG_TOKEN or not CHAT_IDS:
         raise SystemExit("Set TELEGRAM_BOT_TOKEN and TELEGRAM_CHAT_IDS in Environment")
-    if not PUBLIC_URL:
-        raise SystemExit("Set PUBLIC_URL (https://<your-host>) for webhook (или используйте RENDER_EXTERNAL_URL)")
+    if BOT_MODE not in ("webhook", "polling"):
+        raise SystemExit("BOT_MODE must be 'webhook' or 'polling'")
+    if BOT_MODE == "webhook" and not PUBLIC_URL:
+        raise SystemExit("Set PUBLIC_URL (https://<your-host>) for webhook (или используйте RENDER_EXTERNAL_URL), "
+                         "либо BOT_MODE=polling")
+
+    _install_fast_runtime()
 
     application = (
         Application.builder()
         .token(TG_TOKEN)
-        .post_init(_on_start)
+        .request(_TracedRequest(connection_pool_size=256))
+        .concurrent_updates(OrderedUpdateProcessor(MAX_CONCURRENT_UPDATES))  # + антиспам до хендлеров
+        .updater(None)  # апдейты приходят через наш aiohttp-вебхук или _polling_loop
         .build()
     )
 
@@ -1025,20 +3039,12 @@ def main():
     # Callback-кнопки
     application.add_handler(CallbackQueryHandler(on_callback))
 
+    # Инлайн-запросы (@dektrian_online_bot today / week / 25.10) — без меню и TTL
+    application.add_handler(InlineQueryHandler(on_inline_query))
+
     application.add_error_handler(on_error)
 
-    webhook_url = f"{PUBLIC_URL}{WEBHOOK_PATH}"
-    print(f"[WEBHOOK] listen 0.0.0.0:{PORT}  path={WEBHOOK_PATH}  url={webhook_url}")
-
-    application.run_webhook(
-        listen="0.0.0.0",
-        port=PORT,
-        url_path=WEBHOOK_PATH,
-        webhook_url=webhook_url,
-        secret_token=WEBHOOK_SECRET,
-        drop_pending_updates=True,
-        allowed_updates=None,
-    )
+    asyncio.run(_run_bot(application, BOT_MODE))
 
 if __name__ == "__main__":
     main()
@@ -0,0 +1,68 @@
+import asyncio
+import gc
+
+import bot
+
+
+def test_spawn_keeps_task_alive_until_done():
+    async def scenario():
+        done = asyncio.Event()
+
+        async def work():
+            await asyncio.sleep(0.01)
+            done.set()
+
+        bot._spawn(work())
+        gc.collect()
+        await asyncio.wait_for(done.wait(), 1)
+        await asyncio.sleep(0)
+        return len(bot._background_tasks)
+
+    assert asyncio.run(scenario()) == 0
+
+
+def test_spawn_once_skips_duplicate_while_running():
+    async def scenario():
+        runs = []
+        gate = asyncio.Event()
+
+        async def prefetch(n):
+            runs.append(n)
+            await gate.wait()
+
+        first = bot._spawn_once(("k", 1), prefetch(1))
+        second = bot._spawn_once(("k", 1), prefetch(2))
+        other = bot._spawn_once(("k", 2), prefetch(3))
+        gate.set()
+        await asyncio.gather(first, other)
+        await asyncio.sleep(0)
+        third = bot._spawn_once(("k", 1), prefetch(4))
+        await third
+        return runs, first is second, dict(bot._keyed_tasks)
+
+    runs, same, left = asyncio.run(scenario())
+    assert runs == [1, 3, 4]
+    assert same
+    assert left == {}
+
+
+def test_spawned_task_does_not_extend_update_trace():
+    async def scenario():
+        trace = bot._Trace("cb:m|2025-01|0")
+        token = bot._current_trace.set(trace)
+        gate = asyncio.Event()
+
+        async def prefetch():
+            await gate.wait()
+            with bot._span("google.tasks"):
+                pass
+            return bot._current_trace.get()
+
+        task = bot._spawn(prefetch())
+        bot._current_trace.reset(token)
+        gate.set()
+        return trace, await task
+
+    trace, inner = asyncio.run(scenario())
+    assert inner is None
+    assert trace.spans == []
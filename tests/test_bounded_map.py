@@ -0,0 +1,42 @@
+import bot
+from bot import BoundedMap
+
+
+def _clock(monkeypatch, start: float = 1000.0):
+    now = [start]
+    monkeypatch.setattr(bot.time, "monotonic", lambda: now[0])
+    return now
+
+
+def test_purge_expired_after_reads_keeps_no_dead_entries(monkeypatch):
+    now = _clock(monkeypatch)
+    m = BoundedMap("t", max_size=10, ttl=10)
+    m["a"] = 1
+    now[0] += 5
+    m["b"] = 2
+    # чтение старой записи не должно переставить её за более свежую
+    assert m.get("a") == 1
+    now[0] += 6  # "a" истекла, "b" ещё жива
+    m.purge_expired()
+    assert list(m._data) == ["b"]
+    assert m.expirations == 1
+
+
+def test_len_and_stats_count_only_live_entries(monkeypatch):
+    now = _clock(monkeypatch)
+    m = BoundedMap("t", max_size=10, ttl=10)
+    m["a"] = 1
+    m["b"] = 2
+    now[0] += 11
+    assert len(m) == 0
+    assert not m
+    assert m.stats()["size"] == 0
+
+
+def test_lru_without_ttl_still_moves_on_read():
+    m = BoundedMap("t", max_size=2)
+    m["a"] = 1
+    m["b"] = 2
+    assert m.get("a") == 1
+    m["c"] = 3
+    assert "a" in m and "b" not in m
@@ -0,0 +1,175 @@
+import asyncio
+
+import pytest
+import requests
+from telegram.error import RetryAfter, TimedOut, TelegramError
+
+import bot
+from bot import CircuitBreaker, CircuitOpenError
+
+
+def _tripped(reset_seconds: float = 0.0) -> CircuitBreaker:
+    br = CircuitBreaker("test", threshold=2, reset_seconds=reset_seconds)
+    br.record_failure()
+    br.record_failure()
+    return br
+
+
+def test_closed_until_threshold():
+    br = CircuitBreaker("test", threshold=3, reset_seconds=60)
+    br.record_failure()
+    br.record_failure()
+    assert br.state == "closed"
+    assert br.allow()
+    br.record_failure()
+    assert br.state == "open"
+    assert not br.allow()
+
+
+def test_success_resets_failure_count():
+    br = CircuitBreaker("test", threshold=2, reset_seconds=60)
+    br.record_failure()
+    br.record_success()
+    br.record_failure()
+    assert br.state == "closed"
+
+
+def test_half_open_allows_single_probe():
+    br = _tripped()
+    assert br.state == "half-open"
+    assert br.allow()
+    assert not br.allow()
+
+
+def test_probe_success_closes():
+    br = _tripped()
+    assert br.allow()
+    br.record_success()
+    assert br.state == "closed"
+    assert br.allow()
+
+
+def test_probe_failure_reopens():
+    br = _tripped(reset_seconds=60)
+    br.opened_at -= 60  # «прошло» reset_seconds
+    assert br.allow()
+    br.record_failure()
+    assert br.state == "open"
+    assert not br.allow()
+
+
+def test_guard_raises_when_open():
+    br = _tripped(reset_seconds=60)
+    with pytest.raises(CircuitOpenError):
+        with br.guard():
+            pass
+
+
+def test_guard_releases_probe_on_unexpected_exception():
+    br = _tripped()
+    with pytest.raises(ValueError):
+        with br.guard():
+            raise ValueError("boom")
+    assert br.state == "half-open"
+    assert br.allow()
+
+
+@pytest.fixture
+def tg_breaker(monkeypatch):
+    br = _tripped()
+    monkeypatch.setitem(bot._breakers, "telegram", br)
+    return br
+
+
+def test_tg_call_retry_after_does_not_wedge_breaker(tg_breaker):
+    async def flood(**kwargs):
+        raise RetryAfter(0)
+
+    with pytest.raises(RetryAfter):
+        asyncio.run(bot._tg_call(flood, attempts=1))
+    assert tg_breaker.state == "half-open"
+    assert tg_breaker.allow()
+
+
+def test_tg_call_unexpected_error_does_not_wedge_breaker(tg_breaker):
+    async def broken(**kwargs):
+        raise TelegramError("chat migrated")
+
+    with pytest.raises(TelegramError):
+        asyncio.run(bot._tg_call(broken))
+    assert tg_breaker.allow()
+
+
+def test_tg_call_retry_after_then_success_closes(tg_breaker):
+    calls = []
+
+    async def flaky(**kwargs):
+        calls.append(1)
+        if len(calls) == 1:
+            raise RetryAfter(0)
+        return "ok"
+
+    assert asyncio.run(bot._tg_call(flaky, attempts=2)) == "ok"
+    assert tg_breaker.state == "closed"
+
+
+def test_tg_call_timeout_counts_as_failure(tg_breaker):
+    tg_breaker.reset_seconds = 60
+    tg_breaker.opened_at -= 60
+
+    async def slow(**kwargs):
+        raise TimedOut()
+
+    with pytest.raises(TimedOut):
+        asyncio.run(bot._tg_call(slow, attempts=1))
+    assert tg_breaker.state == "open"
+
+
+class _Resp:
+    def __init__(self, status: int, headers=None):
+        self.status_code = status
+        self.headers = headers or {}
+
+    def raise_for_status(self):
+        if self.status_code >= 400:
+            raise requests.HTTPError(str(self.status_code))
+
+
+@pytest.fixture
+def google_breaker(monkeypatch):
+    br = _tripped()
+    monkeypatch.setitem(bot._breakers, "google", br)
+    monkeypatch.setattr(bot.time, "sleep", lambda s: None)
+    return br
+
+
+def test_http_429_probe_does_not_wedge_breaker(monkeypatch, google_breaker):
+    monkeypatch.setattr(bot.requests, "request", lambda *a, **k: _Resp(429, {"Retry-After": "1"}))
+    with pytest.raises(requests.HTTPError):
+        bot._http_request("google", "GET", "https://example.invalid/x", attempts=1)
+    assert google_breaker.state == "half-open"
+    assert google_breaker.allow()
+
+
+def test_http_unexpected_exception_does_not_wedge_breaker(monkeypatch, google_breaker):
+    def boom(*a, **k):
+        raise requests.TooManyRedirects("loop")
+
+    monkeypatch.setattr(bot.requests, "request", boom)
+    with pytest.raises(requests.TooManyRedirects):
+        bot._http_request("google", "GET", "https://example.invalid/x")
+    assert google_breaker.allow()
+
+
+def test_http_5xx_reopens_and_ok_closes(monkeypatch, google_breaker):
+    google_breaker.reset_seconds = 60
+    google_breaker.opened_at -= 60
+    monkeypatch.setattr(bot.requests, "request", lambda *a, **k: _Resp(503))
+    with pytest.raises(requests.HTTPError):
+        bot._http_request("google", "GET", "https://example.invalid/x", attempts=1)
+    assert google_breaker.state == "open"
+
+    google_breaker.opened_at -= 60
+    monkeypatch.setattr(bot.requests, "request", lambda *a, **k: _Resp(200))
+    assert bot._http_request("google", "GET", "https://example.invalid/x").status_code == 200
+    assert google_breaker.state == "closed"
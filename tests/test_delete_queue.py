@@ -0,0 +1,94 @@
+import asyncio
+from types import SimpleNamespace
+
+import pytest
+from telegram.error import BadRequest, Forbidden, NetworkError
+
+import bot
+
+
+class _FakeBot:
+    def __init__(self, batch_error=None, undeletable=()):
+        self.batch_error = batch_error
+        self.undeletable = set(undeletable)
+        self.deleted = []
+        self.single_calls = 0
+
+    async def delete_messages(self, chat_id, message_ids):
+        if self.batch_error:
+            raise self.batch_error
+        self.deleted.extend(message_ids)
+        return True
+
+    async def delete_message(self, chat_id, message_id):
+        self.single_calls += 1
+        if message_id in self.undeletable:
+            raise BadRequest("Message to delete not found")
+        self.deleted.append(message_id)
+        return True
+
+
+@pytest.fixture(autouse=True)
+def clean_state(monkeypatch):
+    monkeypatch.setitem(bot._breakers, "telegram", bot.CircuitBreaker("telegram"))
+    monkeypatch.setattr(bot, "_backoff_delay", lambda attempt: 0.0)
+    for k in bot._delete_stats:
+        monkeypatch.setitem(bot._delete_stats, k, 0)
+    bot._delete_queue.clear()
+    bot._delete_attempts.clear()
+    bot._delete_log.clear()
+    yield
+    bot._delete_queue.clear()
+    bot._delete_attempts.clear()
+
+
+def _flush(fake):
+    asyncio.run(bot._flush_delete_queue(SimpleNamespace(bot=fake)))
+
+
+def test_batch_success_is_recorded_per_batch():
+    for mid in (1, 2, 3):
+        bot._enqueue_delete(-100, mid)
+    fake = _FakeBot()
+    _flush(fake)
+    assert fake.deleted == [1, 2, 3]
+    assert bot._delete_stats["batches_ok"] == 1
+    assert bot._delete_stats["batch_ids_accepted"] == 3
+    assert list(bot._delete_log)[-1][2:5] == ("batch", [1, 2, 3], True)
+
+
+def test_rejected_batch_falls_back_to_single_deletes():
+    for mid in (1, 2, 3):
+        bot._enqueue_delete(-100, mid)
+    fake = _FakeBot(batch_error=BadRequest("message can't be deleted"), undeletable={2})
+    _flush(fake)
+    assert fake.deleted == [1, 3]
+    assert bot._delete_stats["single_ok"] == 2
+    assert bot._delete_stats["single_failed"] == 1
+    assert not bot._delete_queue
+
+
+def test_forbidden_batch_is_dropped_without_single_deletes(monkeypatch):
+    monkeypatch.setattr(bot, "DELETE_BATCH_MAX", 2)
+    for mid in (1, 2, 3):
+        bot._enqueue_delete(-100, mid)
+    fake = _FakeBot(batch_error=Forbidden("bot was kicked from the group chat"))
+    _flush(fake)
+    assert fake.single_calls == 0
+    assert bot._delete_stats["api_calls"] == 1
+    assert bot._delete_stats["batches_failed"] == 1
+    assert bot._delete_stats["dropped"] == 3
+    assert list(bot._delete_log)[-1][2:5] == ("batch", [1, 2, 3], False)
+    assert not bot._delete_queue
+    assert not bot._delete_attempts
+
+
+def test_transient_failure_requeues_then_gives_up():
+    bot._enqueue_delete(-100, 1)
+    fake = _FakeBot(batch_error=NetworkError("connection reset"))
+    for _ in range(bot.DELETE_MAX_ATTEMPTS):
+        _flush(fake)
+    assert bot._delete_stats["requeued"] == bot.DELETE_MAX_ATTEMPTS - 1
+    assert bot._delete_stats["dropped"] == 1
+    assert not bot._delete_queue
+    assert not bot._delete_attempts
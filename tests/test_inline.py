@@ -0,0 +1,88 @@
+import asyncio
+import time
+
+from telegram import Update
+
+import bot
+
+
+def test_stale_cache_answers_without_waiting_for_google(monkeypatch):
+    fetched = []
+
+    def slow_fetch():
+        time.sleep(0.3)
+        fetched.append(1)
+        return []
+
+    monkeypatch.setattr(bot, "_tasks_fetch_all_strict", slow_fetch)
+    monkeypatch.setitem(bot._tasks_cache, "items", [])
+    monkeypatch.setitem(bot._tasks_cache, "ver", 3)
+    monkeypatch.setitem(bot._tasks_cache, "ts", time.time() - bot.TASKS_CACHE_TTL_SECONDS - 1)
+    monkeypatch.setitem(bot._tasks_cache, "digest", bot._tasks_digest([]))
+
+    async def scenario():
+        t0 = time.perf_counter()
+        idx = await bot._get_schedule_index()
+        elapsed = time.perf_counter() - t0
+        refresh = bot._keyed_tasks.get("tasks_refresh")
+        await refresh
+        return idx, elapsed
+
+    idx, elapsed = asyncio.run(scenario())
+    assert elapsed < 0.1
+    assert idx["today"]
+    assert fetched == [1]
+
+
+def _inline_update(update_id: int, user_id: int, query: str) -> Update:
+    return Update.de_json({
+        "update_id": update_id,
+        "inline_query": {
+            "id": str(update_id),
+            "from": {"id": user_id, "is_bot": False, "first_name": "u"},
+            "query": query,
+            "offset": "",
+        },
+    }, None)
+
+
+def _callback_update(update_id: int, user_id: int, data: str) -> Update:
+    return Update.de_json({
+        "update_id": update_id,
+        "callback_query": {
+            "id": str(update_id),
+            "from": {"id": user_id, "is_bot": False, "first_name": "u"},
+            "chat_instance": "ci",
+            "data": data,
+        },
+    }, None)
+
+
+def test_rate_limited_inline_query_is_answered_from_index(monkeypatch):
+    monkeypatch.setattr(bot, "RATE_USER_BURST", 1.0)
+    monkeypatch.setattr(bot, "RATE_USER_PER_SEC", 0.0)
+    bot._rate_buckets.clear()
+    today = bot.now_local().date()
+    monkeypatch.setitem(bot._schedule_index, "key", (1, today))
+    monkeypatch.setitem(bot._schedule_index, "today", "сегодня пусто")
+    monkeypatch.setitem(bot._schedule_index, "week", "неделя пуста")
+    monkeypatch.setitem(bot._schedule_index, "days", {today: "сегодня пусто"})
+    answered = []
+
+    async def fake_answer(iq, results):
+        answered.append([r.id for r in results])
+
+    monkeypatch.setattr(bot, "_answer_inline", fake_answer)
+
+    async def scenario():
+        assert not await bot._rate_limit_drop(_inline_update(1, 5, "today"))
+        assert await bot._rate_limit_drop(_inline_update(2, 5, "today"))
+
+    asyncio.run(scenario())
+    assert answered == [["today"]]
+
+
+def test_menu_navigation_callbacks_are_not_rate_limited():
+    assert not bot._is_costly_update(_callback_update(1, 5, "m|2026-10|1"))
+    assert not bot._is_costly_update(_callback_update(2, 5, "menu|main"))
+    assert bot._is_costly_update(_callback_update(3, 5, "menu|month"))
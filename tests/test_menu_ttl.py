@@ -0,0 +1,56 @@
+import asyncio
+
+import bot
+
+
+def test_extending_menu_ttl_keeps_anchor_alive(monkeypatch):
+    clock = [1000.0]
+    monkeypatch.setattr(bot.time, "monotonic", lambda: clock[0])
+    monkeypatch.setattr(bot, "_enqueue_delete", lambda chat_id, message_id: None)
+    bot._user_menu_anchor.clear()
+
+    async def scenario():
+        bot._user_menu_anchor[(-100, 7)] = 55
+        bot._arm_menu_ttl(-100, 55)
+        # меню листают дольше TTL якоря, каждый клик продлевает меню
+        for _ in range(4):
+            clock[0] += bot.MENU_TTL_SECONDS
+            bot._extend_menu_ttl(-100, 55)
+        anchor = bot._user_menu_anchor.get((-100, 7))
+        bot._cancel_menu_timer(-100, 55)
+        return anchor
+
+    try:
+        assert asyncio.run(scenario()) == 55
+    finally:
+        bot._user_menu_anchor.clear()
+
+
+def test_restart_keeps_remaining_ttl_and_anchors(tmp_path, monkeypatch):
+    bot._state_close()
+    monkeypatch.setattr(bot, "STATE_DB_PATH", str(tmp_path / "state.sqlite3"))
+    monkeypatch.setattr(bot, "_enqueue_delete", lambda chat_id, message_id: None)
+    bot._user_menu_anchor.clear()
+
+    async def before_restart():
+        bot._arm_menu_ttl(-100, 55, delay=120)
+        bot._user_menu_anchor[(-100, 7)] = 55
+        bot._persist_menu_timers()
+        await asyncio.sleep(0)
+
+    async def after_restart():
+        bot._user_menu_anchor.clear()
+        bot._restore_menu_timers()
+        task, expires_at = bot._menu_timers.get((-100, 55))
+        anchor = bot._user_menu_anchor.get((-100, 7))
+        bot._cancel_menu_timer(-100, 55)
+        return expires_at - bot.time.time(), anchor
+
+    try:
+        asyncio.run(before_restart())
+        remaining, anchor = asyncio.run(after_restart())
+        assert 100 < remaining <= 120
+        assert anchor == 55
+    finally:
+        bot._user_menu_anchor.clear()
+        bot._state_close()
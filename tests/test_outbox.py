@@ -0,0 +1,46 @@
+import asyncio
+from types import SimpleNamespace
+
+import pytest
+from telegram.error import BadRequest, NetworkError, TimedOut
+
+import bot
+
+
+@pytest.fixture(autouse=True)
+def fresh_breaker(monkeypatch):
+    monkeypatch.setitem(bot._breakers, "telegram", bot.CircuitBreaker("telegram"))
+
+
+class _FakeBot:
+    def __init__(self, photo_error: Exception):
+        self.photo_error = photo_error
+        self.sent_text = []
+
+    async def send_photo(self, **kwargs):
+        raise self.photo_error
+
+    async def send_message(self, **kwargs):
+        self.sent_text.append(kwargs["text"])
+        return SimpleNamespace(message_id=1)
+
+
+def _deliver(fake: _FakeBot):
+    app = SimpleNamespace(bot=fake)
+    return asyncio.run(bot._deliver_photo_first(app, -100, "hello", None, "https://img.invalid/p.jpg", True))
+
+
+def test_bad_request_falls_back_to_link():
+    fake = _FakeBot(BadRequest("wrong file identifier"))
+    msg, is_photo = _deliver(fake)
+    assert not is_photo
+    assert fake.sent_text == ["https://img.invalid/p.jpg\n\nhello"]
+
+
+@pytest.mark.parametrize("error", [TimedOut(), NetworkError("connection reset")])
+def test_uncertain_photo_is_not_followed_by_text(error, monkeypatch):
+    monkeypatch.setattr(bot, "_backoff_delay", lambda attempt: 0.0)
+    fake = _FakeBot(error)
+    with pytest.raises(type(error)):
+        _deliver(fake)
+    assert fake.sent_text == []
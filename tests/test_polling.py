@@ -0,0 +1,53 @@
+import asyncio
+
+import pytest
+from telegram import Update
+
+import bot
+
+
+def _update(update_id: int) -> Update:
+    return Update.de_json({
+        "update_id": update_id,
+        "message": {"message_id": update_id, "date": 0, "chat": {"id": 1, "type": "private"}, "text": "x"},
+    }, None)
+
+
+@pytest.fixture
+def state_db(tmp_path, monkeypatch):
+    bot._state_close()
+    monkeypatch.setattr(bot, "STATE_DB_PATH", str(tmp_path / "state.sqlite3"))
+    yield
+    monkeypatch.setattr(bot, "_poll_tracker", None)
+    bot._state_close()
+
+
+def test_watermark_is_lowest_unfinished_update():
+    async def scenario():
+        tr = bot._PollTracker(fetched=13)
+        tr.inflight.update({10, 11, 12})
+        marks = [tr.watermark]
+        tr.inflight.discard(11)
+        marks.append(tr.watermark)
+        tr.inflight.discard(10)
+        marks.append(tr.watermark)
+        tr.inflight.discard(12)
+        marks.append(tr.watermark)
+        return marks
+
+    assert asyncio.run(scenario()) == [10, 10, 12, 13]
+
+
+def test_unfinished_updates_survive_in_journal(state_db, monkeypatch):
+    async def scenario():
+        monkeypatch.setattr(bot, "_poll_tracker", bot._PollTracker(fetched=None))
+        batch = [_update(n) for n in (5, 6, 7)]
+        bot._poll_journal_add(batch, 8)
+        bot._poll_tracker.inflight.update({5, 6, 7})
+        bot._poll_update_finished(batch[0])
+        bot._poll_update_finished(batch[2])
+        return bot._poll_tracker.watermark
+
+    assert asyncio.run(scenario()) == 6
+    assert bot._poll_offset_get() == 8
+    assert [u.update_id for u in bot._poll_journal_load(None)] == [6]
@@ -0,0 +1,144 @@
+import asyncio
+import time
+
+from telegram import Update
+
+from bot import OrderedUpdateProcessor
+
+
+def _message_update(update_id: int, user_id: int, chat_id: int = -100, text: str = "hi") -> Update:
+    return Update.de_json({
+        "update_id": update_id,
+        "message": {
+            "message_id": update_id,
+            "date": 0,
+            "chat": {"id": chat_id, "type": "group"},
+            "from": {"id": user_id, "is_bot": False, "first_name": "u"},
+            "text": text,
+        },
+    }, None)
+
+
+def test_same_user_updates_run_in_order():
+    async def scenario():
+        p = OrderedUpdateProcessor(8)
+        order = []
+
+        async def handler(n: int, delay: float):
+            await asyncio.sleep(delay)
+            order.append(n)
+
+        # первый апдейт самый медленный — без упорядочивания он закончил бы последним
+        await asyncio.gather(*(
+            p.process_update(_message_update(n, user_id=1), handler(n, 0.05 - n * 0.01)) for n in range(4)
+        ))
+        return order, p
+
+    order, p = asyncio.run(scenario())
+    assert order == [0, 1, 2, 3]
+    assert p._locks == {}
+
+
+def test_waiting_updates_do_not_hold_slots():
+    async def scenario():
+        p = OrderedUpdateProcessor(2)
+        t0 = time.perf_counter()
+        finished = {}
+
+        async def handler(name: str, delay: float):
+            await asyncio.sleep(delay)
+            finished[name] = time.perf_counter() - t0
+
+        busy = [asyncio.create_task(p.process_update(_message_update(n, user_id=1), handler(f"a{n}", 0.2)))
+                for n in range(4)]
+        await asyncio.sleep(0.01)
+        await p.process_update(_message_update(99, user_id=2), handler("b", 0.0))
+        await asyncio.gather(*busy)
+        return finished, p
+
+    finished, p = asyncio.run(scenario())
+    # очередь пользователя 1 держит один слот, второй свободен для пользователя 2
+    assert finished["b"] < 0.1
+    assert p.current_concurrent_updates == 0
+
+
+def test_cancelled_while_waiting_releases_lock():
+    async def scenario():
+        p = OrderedUpdateProcessor(1)
+        gate = asyncio.Event()
+
+        async def blocker():
+            await gate.wait()
+
+        async def never():
+            raise AssertionError("must not run")
+
+        first = asyncio.create_task(p.process_update(_message_update(1, user_id=1), blocker()))
+        await asyncio.sleep(0)
+        waiting = asyncio.create_task(p.process_update(_message_update(2, user_id=1), never()))
+        await asyncio.sleep(0.01)
+        waiting.cancel()
+        gate.set()
+        await first
+        await asyncio.gather(waiting, return_exceptions=True)
+        return p
+
+    p = asyncio.run(scenario())
+    assert p._locks == {}
+    assert p.current_concurrent_updates == 0
+
+
+def test_rate_limited_updates_skip_locks_and_slots(monkeypatch):
+    import bot
+
+    monkeypatch.setattr(bot, "RATE_USER_BURST", 2.0)
+    monkeypatch.setattr(bot, "RATE_USER_PER_SEC", 0.0)
+    monkeypatch.setattr(bot, "RATE_CHAT_BURST", 100.0)
+    monkeypatch.setattr(bot, "_enqueue_delete", lambda chat_id, message_id: None)
+    bot._rate_buckets.clear()
+
+    def menu_press(update_id: int) -> Update:
+        return _message_update(update_id, user_id=7, text=bot.KB_LABEL)
+
+    async def scenario():
+        p = OrderedUpdateProcessor(1)
+        ran = []
+        gate = asyncio.Event()
+
+        async def handler(n: int):
+            ran.append(n)
+            await gate.wait()
+
+        first = asyncio.create_task(p.process_update(menu_press(1), handler(1)))
+        await asyncio.sleep(0)
+        second = asyncio.create_task(p.process_update(menu_press(2), handler(2)))
+        await asyncio.sleep(0)
+        # третье нажатие сверх лимита: отбрасывается сразу, не дожидаясь ни очереди, ни слота
+        await asyncio.wait_for(p.process_update(menu_press(3), handler(3)), timeout=0.5)
+        gate.set()
+        await asyncio.gather(first, second)
+        return ran
+
+    assert asyncio.run(scenario()) == [1, 2]
+
+
+def test_cancel_inflight_stops_running_and_new_updates():
+    async def scenario():
+        p = OrderedUpdateProcessor(4)
+        ran = []
+
+        async def slow(n: int):
+            ran.append(n)
+            await asyncio.sleep(10)
+
+        running = [asyncio.create_task(p.process_update(_message_update(n, user_id=n), slow(n))) for n in (1, 2)]
+        await asyncio.sleep(0.01)
+        cancelled = p.cancel_inflight()
+        results = await asyncio.gather(*running, return_exceptions=True)
+        await asyncio.wait_for(p.process_update(_message_update(3, user_id=3), slow(3)), timeout=0.5)
+        return cancelled, results, ran
+
+    cancelled, results, ran = asyncio.run(scenario())
+    assert cancelled == 2
+    assert all(isinstance(r, asyncio.CancelledError) for r in results)
+    assert ran == [1, 2]